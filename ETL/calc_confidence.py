@@ -1,19 +1,19 @@
-import re
 import os
 import json
+import hashlib
 import h5py as h5
 import numpy as np
 import pandas as pd
 from sklearn.decomposition import PCA
-from matplotlib import pyplot as plt
-from matplotlib.lines import Line2D
 from scipy.stats import zscore
-import plotly.graph_objects as go
 from maayanlab_bioinformatics.normalization import quantile_normalize
 from sklearn.metrics import silhouette_score
 from tqdm import tqdm
 import math
 from itertools import combinations
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from expression import ExpressionReader
 
 def dist(p1, p2):
     (x1, y1), (x2, y2) = p1, p2
@@ -26,73 +26,133 @@ def calc_avg_distance(x, y):
     return avg_distance
 
 
-def log2_normalize(x, offset=1.):
-    return np.log2(x + offset)
-
-
-def compute_confidence(species: str, version: str, base_path: str = ""):
+def normalize_expression(expression_data):
+    ''' Library size then reference normalization of a genes x samples block, the reference of a
+    gene being the square root of its mean. Genes with undefined values are dropped.
+    :return: The normalized block and the mask of the genes kept
+    '''
+    X = expression_data / expression_data.sum(axis=0, keepdims=True, dtype=np.float64)
+    X /= np.sqrt(X.mean(axis=1, keepdims=True))
+    keep = ~np.isnan(X).any(axis=1)
+    return X[keep], keep
+
+
+def confidence_score(gse, gsms, expression_data, conditions):
+    ''' Silhouette score of the conditions of a GSE in the 2D PCA of its normalized expression,
+    -2 when it cannot be computed
+    '''
+    try:
+        X, _ = normalize_expression(expression_data)
+        df_data_norm = quantile_normalize(pd.DataFrame(X, columns=gsms), axis=0)
+        #convert to zscores
+        Z = zscore(df_data_norm.values, axis=0)
+        result_expr = PCA(n_components=2).fit_transform(Z.T)
+        return gse, float(silhouette_score(result_expr, conditions))
+    except Exception as e:
+        print(gse, e)
+        return gse, -2
+
+
+def run_scores(jobs, record, n_jobs: int = None):
+    ''' Run `confidence_score` arguments in-process or across a pool of `n_jobs` workers,
+    passing every result to `record` as soon as it is known.
+    '''
+    if n_jobs == 1:
+        for job in jobs:
+            record(*confidence_score(*job))
+        return
+    n_jobs = n_jobs or os.cpu_count()
+    # spawn rather than fork, other stages of the release pipeline may be running in this process
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp.get_context('spawn')) as pool:
+        in_flight = set()
+        for job in jobs:
+            in_flight.add(pool.submit(confidence_score, *job))
+            # bound the number of expression blocks held in memory
+            if len(in_flight) >= 2 * n_jobs:
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    record(*fut.result())
+        for fut in wait(in_flight).done:
+            record(*fut.result())
+
+
+def groups_hash(samples: dict):
+    ''' Fingerprint of the sample groups of a GSE, a checkpointed score is only reused for the same groups
+    '''
+    return hashlib.sha1(json.dumps(samples, sort_keys=True).encode()).hexdigest()
+
+
+def load_scores(path: str):
+    ''' The checkpointed scores, a mapping from GSE to `(groups_hash, silhouette_score)`
+    '''
+    scores = {}
+    if os.path.exists(path):
+        with open(path) as fr:
+            for line in fr:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line may be torn if the previous run was killed
+                    continue
+                scores[record['gse']] = (record.get('groups'), record['silhouette_score'])
+    return scores
+
+
+def compute_confidence(species: str, version: str, base_path: str = "", jobs: int = None):
+    ''' Silhouette score of every processed GSE. Scores are checkpointed to
+    out/cache/confidence_<species>_<version>.jsonl as they are computed, along with a hash of
+    the sample groups, so a restart skips the GSEs already scored with the same groups.
+    :param jobs: Number of worker processes, all CPUs by default, 1 to score in-process
+    '''
     if os.path.exists(f'out/meta/gse_processed_meta_{species}_{version}_conf.json'):
         return
     
     with open(f'out/meta/gse_processed_meta_{species}_{version}.json') as f:
         gse_processed_meta = json.load(f)
 
-    f = h5.File(f"{base_path}{species}_gene_v{version}.h5", "r")
-
-    genes = [x.decode('UTF-8') for x in f['meta/genes/symbol']]
-    samples = [x.decode('UTF-8') for x in f['meta/samples/geo_accession']] 
-
-    for gse in tqdm(list(gse_processed_meta)):
-        gsms = []
-        [gsms.extend(gr) for gr in gse_processed_meta[gse]['samples'].values()]
-        condition_dict = {}
-        condition_names_valid = True
-
-        # a few condition names are duplicated, so we need to make sure that the condition names are unique
-        # this may indiciate that conditions were not grouped effectively, but we can observe this later
+    checkpoint = f'out/cache/confidence_{species}_{version}.jsonl'
+    hashes = {gse: groups_hash(gse_processed_meta[gse]['samples']) for gse in gse_processed_meta}
+    scores = {
+        gse: score
+        for gse, (h, score) in load_scores(checkpoint).items()
+        if hashes.get(gse) == h
+    }
+    os.makedirs('out/cache', exist_ok=True)
+
+    study_gsms = {
+        gse: [gsm for gr in gse_processed_meta[gse]['samples'].values() for gsm in gr]
+        for gse in gse_processed_meta
+        if gse not in scores
+    }
+    print(f'{len(scores)} GSEs already scored, {len(study_gsms)} to go')
 
-        if len(list(set(gse_processed_meta[gse]['titles'].values()))) !=  len(list(gse_processed_meta[gse]['titles'].values())):
-            condition_names_valid = False
-
-        for cond in gse_processed_meta[gse]['samples']:
-            for gsm in gse_processed_meta[gse]['samples'][cond]:
-                condition_dict[gsm] = cond
-            
-
-        samples_idx = sorted([i for i, x in enumerate(samples) if x in gsms])
-
-        expression_data = f['data/expression'][:, samples_idx]
-        #samples_readsaligned = f['meta']['samples']['readsaligned'][samples_idx]
-        samples_readsaligned = np.sum(expression_data, axis=0)
-        expression_data = np.divide(expression_data, samples_readsaligned)
-
-        expr_df = pd.DataFrame(data=expression_data, index=genes, columns=gsms)
-        reference = np.sqrt(expr_df.mean(axis=1))
-
-        for col in expr_df.columns:
-            expr_df[col] = np.true_divide(expr_df[col], reference)
-
-        expr_df = expr_df.dropna()
-        expr_df
+    f = h5.File(f"{base_path}{species}_gene_v{version}.h5", "r")
+    fw = open(checkpoint, 'a')
+    try:
+        reader = ExpressionReader(f)
+
+        def score_jobs():
+            for gse, gsms, expression_data in tqdm(reader.iter_groups(study_gsms), total=len(study_gsms)):
+                condition_dict = {
+                    gsm: cond
+                    for cond in gse_processed_meta[gse]['samples']
+                    for gsm in gse_processed_meta[gse]['samples'][cond]
+                }
+                yield gse, gsms, expression_data, [condition_dict[gsm] for gsm in gsms]
+
+        def record(gse, s_score):
+            scores[gse] = s_score
+            fw.write(json.dumps(dict(gse=gse, groups=hashes[gse], silhouette_score=s_score)) + '\n')
+            fw.flush()
+
+        run_scores(score_jobs(), record, jobs)
+    finally:
+        fw.close()
+        f.close()
+
+    for gse in gse_processed_meta:
+        if gse in scores:
+            gse_processed_meta[gse]['silhouette_score'] = scores[gse]
 
-        df_data_norm = log2_normalize(expr_df, offset=1)
-        df_data_norm = quantile_normalize(expr_df, axis=0)
-        #convert to zscores
-        expr_df = pd.DataFrame(zscore(df_data_norm, axis=0), index=df_data_norm.index, columns=df_data_norm.columns)
-
-        X = expr_df.T.values
-        pca = PCA(n_components=2)
-        result_expr = pca.fit_transform(X)
-        pca_df = pd.DataFrame(result_expr, columns = ['PCA-1','PCA-2'])
-        pca_df['sample'] = expr_df.columns
-        pca_df['condition'] = pca_df['sample'].apply(lambda x: condition_dict[x])
-
-        try:
-            s_score = silhouette_score(pca_df[['PCA-1', 'PCA-2']], pca_df['condition'])
-            gse_processed_meta[gse]['silhouette_score'] = s_score
-        except Exception as e:
-            print(gse, e)
-            gse_processed_meta[gse]['silhouette_score'] = -2
-        
     with open(f'out/meta/gse_processed_meta_{species}_{version}_conf.json', 'w') as f:
-        json.dump(gse_processed_meta, f)
\ No newline at end of file
+        json.dump(gse_processed_meta, f)
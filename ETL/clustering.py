@@ -0,0 +1,106 @@
+import numpy as np
+from tqdm import tqdm
+
+backends = ('kmeans', 'agglomerative', 'sklearn')
+
+
+def batched_kmeans(X, mask, ks, n_init: int = 10, max_iter: int = 100, seed: int = 0):
+    ''' k-means++ / Lloyd's algorithm run on many small problems at once.
+
+    Centers are kept as weights over each problem's points, so every distance comes
+     from the (N, N) Gram matrix and the cost does not depend on the embedding size.
+    :param X: (B, N, D) points of B problems padded to N points
+    :param mask: (B, N) True for real points, False for padding
+    :param ks: (B,) number of clusters of each problem
+    :return: (B, N) cluster labels, -1 on padding
+    '''
+    rng = np.random.default_rng(seed)
+    B, N, _ = X.shape
+    K = int(ks.max())
+    batch = np.arange(B)[:, None]
+    valid_k = np.arange(K)[None, :] < ks[:, None]
+    point_mask = mask[:, None, :]
+    G = X @ X.transpose(0, 2, 1)
+    sq = np.einsum('bnn->bn', G)
+
+    def sqdist(W):
+        # (B, I, N, K) squared distances to the centers W @ X, clusters beyond a problem's k are never the closest
+        xc = G[:, None] @ W.transpose(0, 1, 3, 2)
+        cc = ((W @ G[:, None]) * W).sum(-1)
+        d = sq[:, None, :, None] - 2 * xc + cc[:, :, None, :]
+        return np.where(valid_k[:, None, None, :], np.maximum(d, 0), np.inf)
+
+    # k-means++ seeding, n_init independent seedings per problem
+    uniform = np.broadcast_to(point_mask, (B, n_init, N)).astype(G.dtype)
+    W = np.zeros((B, n_init, K, N), dtype=G.dtype)
+    weights = uniform
+    closest = None
+    for j in range(K):
+        total = weights.sum(-1, keepdims=True)
+        p = np.where(total > 0, weights / np.where(total > 0, total, 1), uniform / uniform.sum(-1, keepdims=True))
+        idx = np.minimum((p.cumsum(-1) < rng.random((B, n_init, 1))).sum(-1), N - 1)
+        W[batch, np.arange(n_init)[None, :], j, idx] = 1
+        d = sq[:, None, :] - 2 * G[batch, idx] + sq[batch, idx][..., None]
+        closest = d if closest is None else np.minimum(closest, d)
+        weights = np.where(point_mask, np.maximum(closest, 0), 0)
+
+    labels = None
+    for _ in range(max_iter):
+        new_labels = sqdist(W).argmin(-1)
+        if labels is not None and np.all((new_labels == labels) | ~point_mask):
+            break
+        labels = new_labels
+        onehot = ((labels[..., None] == np.arange(K)) & point_mask[..., None]).transpose(0, 1, 3, 2)
+        counts = onehot.sum(-1, keepdims=True)
+        # an empty cluster keeps its previous center
+        W = np.where(counts > 0, onehot / np.maximum(counts, 1), W)
+
+    d = sqdist(W)
+    labels = d.argmin(-1)
+    inertia = np.where(point_mask, d.min(-1), 0).sum(-1)
+    labels = labels[np.arange(B), inertia.argmin(1)]
+    labels[~mask] = -1
+    return labels
+
+
+def agglomerative(X, k: int):
+    ''' Deterministic average-linkage clustering on cosine distances cut at `k` clusters
+    '''
+    from scipy.cluster.hierarchy import linkage, fcluster
+    return fcluster(linkage(X, method='average', metric='cosine'), t=k, criterion='maxclust') - 1
+
+
+def cluster_gses(embeddings: dict, n_clusters: dict, backend: str = 'kmeans', batch_size: int = 256, seed: int = 0):
+    ''' Cluster the sample embeddings of many GSEs.
+    :param embeddings: A mapping from GSE to its (samples, dim) embedding matrix
+    :param n_clusters: A mapping from GSE to the number of clusters to find
+    :param backend: `kmeans` (batched, padded numpy k-means), `agglomerative` or `sklearn`
+    :return: A mapping from GSE to the cluster label of each sample
+    '''
+    if backend not in backends:
+        raise ValueError(f'Unknown clustering backend {backend}, expected one of {backends}')
+    labels = {}
+    if backend == 'agglomerative':
+        for gse in tqdm(embeddings, desc='Clustering...'):
+            labels[gse] = agglomerative(embeddings[gse], n_clusters[gse])
+    elif backend == 'sklearn':
+        from sklearn.cluster import KMeans
+        for gse in tqdm(embeddings, desc='Clustering...'):
+            labels[gse] = KMeans(n_clusters=n_clusters[gse], n_init=10).fit(embeddings[gse]).labels_
+    else:
+        # batch GSEs of similar size together to keep the padding small
+        gses = sorted(embeddings, key=lambda gse: len(embeddings[gse]))
+        for i in tqdm(range(0, len(gses), batch_size), desc='Clustering...'):
+            chunk = gses[i:i+batch_size]
+            N = max(len(embeddings[gse]) for gse in chunk)
+            D = embeddings[chunk[0]].shape[1]
+            X = np.zeros((len(chunk), N, D), dtype=np.float64)
+            mask = np.zeros((len(chunk), N), dtype=bool)
+            for b, gse in enumerate(chunk):
+                X[b, :len(embeddings[gse])] = embeddings[gse]
+                mask[b, :len(embeddings[gse])] = True
+            ks = np.array([n_clusters[gse] for gse in chunk])
+            chunk_labels = batched_kmeans(X, mask, ks, seed=seed + i)
+            for b, gse in enumerate(chunk):
+                labels[gse] = chunk_labels[b, :len(embeddings[gse])]
+    return labels
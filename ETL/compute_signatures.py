@@ -2,23 +2,19 @@
 import pandas as pd
 import h5py as h5
 import json
-import numpy as np
 from tqdm import tqdm
-import matplotlib.pyplot as plt
-import rpy2
 from maayanlab_bioinformatics.dge import limma_voom_differential_expression
 import os
-import re
-from tqdm import tqdm
 import sys
 import contextlib
+from collections import deque
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from expression import ExpressionReader
+from condition_labels import load_sample_tokens
+from signature_store import SignatureStore
 
 pd.options.mode.chained_assignment = None
-import nltk
-from nltk.corpus import stopwords
-nltk.download('stopwords')
-words_to_remove = ['experiement', 'tissue:', 'type:', 'batch:', 'treatment:', 'experiment', 'patient', 'batch', '1', '2', '3', '4', '5', '6', '7', '8', '9']
-stopwords_plus = set(stopwords.words('english') + (words_to_remove))
 
 @contextlib.contextmanager
 def suppress_output(stdout=True, stderr=True, dest='/dev/null'):
@@ -43,22 +39,19 @@ def suppress_output(stdout=True, stderr=True, dest='/dev/null'):
 
 
 # %%
-pattern = r'[-,_.:]'
+ctrl_keywords = set(['wt', 'wildtype', 'control', 'cntrl', 'ctrl', 'uninfected', 'normal', 'untreated', 'unstimulated', 'shctrl', 'ctl', 'healthy', 'sictrl', 'sicontrol', 'ctr', 'wild', 'dmso'])
 
-def compute_sigs(expr_df, groupings, species, gse, gse_table, version):
+def plan_comparisons(groupings, species, gse, tokens):
+    ''' Label each condition from the common terms across its samples, put control
+    conditions first and return the `(sig_name, samps, samps2)` comparisons to compute.
+    :param tokens: The `condition_labels.SampleTokens` of the release
+    '''
     # Compute label of condition from common terms across samples
     og_labels = {}
     labled_groupings = {}
     for label in groupings:
         samps = groupings[label]
-        data = list(map(lambda s: s.lower(), gse_table[gse_table['gsm'].isin(samps)]['combined'].values))
-        data_clean = []
-        for d in data:
-            data_clean.append(set(filter(lambda w: w not in stopwords_plus, re.sub(pattern, ' ', d).split())))
-        condition = set(data_clean[0])
-        for s in data_clean[1:]:
-            condition.intersection_update(s)
-        condition = ' '.join(list(condition))
+        condition = tokens.label('comparison', samps)
         labled_groupings[condition] = samps
         og_labels[condition] = label
 
@@ -66,7 +59,6 @@ def compute_sigs(expr_df, groupings, species, gse, gse_table, version):
     ctrl_conditions = []
     conditions = list(labled_groupings.keys())
     # identify control conditions or use first condition as default
-    ctrl_keywords = set(['wt', 'wildtype', 'control', 'cntrl', 'ctrl', 'uninfected', 'normal', 'untreated', 'unstimulated', 'shctrl', 'ctl', 'healthy', 'sictrl', 'sicontrol', 'ctr', 'wild', 'dmso'])
     for condition in labled_groupings:
         split_conditions = condition.lower().split()
         if len(set(split_conditions).intersection(ctrl_keywords)) > 0:
@@ -77,6 +69,7 @@ def compute_sigs(expr_df, groupings, species, gse, gse_table, version):
         for ctrl_c in ctrl_conditions:
             conditions.insert(0, conditions.pop(conditions.index(ctrl_c)))
 
+    comparisons = []
     seen = []
     for condition in conditions:
         for condition2 in conditions:
@@ -84,72 +77,183 @@ def compute_sigs(expr_df, groupings, species, gse, gse_table, version):
                 seen.append({og_labels[condition], og_labels[condition2]})
 
                 sig_name = f"{gse}-{og_labels[condition]}-vs-{og_labels[condition2]}-{species}"
+                comparisons.append((sig_name, labled_groupings[condition], labled_groupings[condition2]))
+    return comparisons
+
+
+def compute_dge(ctrl_df, case_df):
+    with suppress_output():
+        dge = limma_voom_differential_expression(
+            ctrl_df, case_df,
+            voom_design=True,
+        )
+    if not dge.empty:
+        dge['logFC'] = dge['logFC'].round(2)
+        dge['AveExpr'] = dge['AveExpr'].round(2)
+        dge['t'] = dge['t'].round(2)
+        dge['B'] = dge['B'].round(2)
+    return dge
+
+
+def compute_job(sig_name, ctrl_df, case_df):
+    ''' Compute a single signature, returning `(sig_name, status, error, dge)`.
+    This runs inside the worker processes, each of which holds its own R session.
+    '''
+    try:
+        dge = compute_dge(ctrl_df, case_df)
+    except Exception as e:
+        return sig_name, 'failed', str(e), None
+    if dge.empty:
+        return sig_name, 'empty', None, None
+    return sig_name, 'done', None, dge[list(SignatureStore.fields)]
+
+
+class SignatureQueue:
+    ''' A persistent work queue of (GSE, condition pair) comparisons.
 
-                if not os.path.exists(f'out/data_{species}_{version}/{sig_name}.tsv.gz'):
+    Jobs and their outcomes are appended to a JSONL file, the latest record for a
+     signature wins, so an interrupted run resumes with exactly the jobs left pending.
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        self.jobs = {}
+        self.status = {}
+        if os.path.exists(path):
+            with open(path) as fr:
+                for line in fr:
                     try:
-                        with suppress_output():
-                            dge = limma_voom_differential_expression(
-                                expr_df[labled_groupings[condition]], expr_df[labled_groupings[condition2]],
-                                voom_design=True,
-                            )
-                        if not dge.empty:
-                            dge['logFC'] = dge['logFC'].round(2)
-                            dge['AveExpr'] = dge['AveExpr'].round(2)
-                            dge['t'] = dge['t'].round(2)
-                            dge['B'] = dge['B'].round(2)
-                            dge.to_csv(f'out/data_{species}_{version}/{sig_name}.tsv.gz', sep='\t', compression='gzip')
-                        else:
-                            print('Empty dge returned for', sig_name)
-                    except Exception as e:
-                        print(e)
-                        print('Error computing:', sig_name)
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # the last line may be torn if the previous run was killed
+                        continue
+                    if 'gse' in record:
+                        self.jobs[record['sig']] = (record['gse'], record['samps'], record['samps2'])
+                    self.status[record['sig']] = record['status']
+        self.fw = open(path, 'a')
+
+    def planned(self):
+        return {gse for gse, _, _ in self.jobs.values()}
+
+    def add(self, gse, sig_name, samps, samps2, status='pending'):
+        self.jobs[sig_name] = (gse, samps, samps2)
+        self.status[sig_name] = status
+        self._write(dict(sig=sig_name, status=status, gse=gse, samps=samps, samps2=samps2))
+
+    def record(self, sig_name, status, error=None):
+        self.status[sig_name] = status
+        if status == 'failed':
+            print('Error computing:', sig_name, error)
+        elif status == 'empty':
+            print('Empty dge returned for', sig_name)
+        self._write(dict(sig=sig_name, status=status, error=error))
+
+    def pending(self, retry_failed=False):
+        ''' Pending jobs grouped by GSE
+        '''
+        todo = {'pending', 'failed'} if retry_failed else {'pending'}
+        pending = {}
+        for sig_name, (gse, samps, samps2) in self.jobs.items():
+            if self.status[sig_name] in todo:
+                pending.setdefault(gse, []).append((sig_name, samps, samps2))
+        return pending
+
+    def _write(self, record):
+        self.fw.write(json.dumps(record) + '\n')
+        self.fw.flush()
+
+    def close(self):
+        self.fw.close()
+
+
+def run_jobs(jobs, record, n_jobs: int = 1, max_ahead: int = 64):
+    ''' Run `compute_job` arguments across a pool of `n_jobs` workers, passing every result
+    to `record` in the order of `jobs`, so the signature store and the GMT built from it come
+    out in the same order whatever order the workers finish in.
+    R always runs in a worker, even for a single job: `suppress_output` swaps the streams of
+     the whole process, which would silence the other stages of the release pipeline running
+     in threads of this process.
+    :param max_ahead: Results held back waiting for an earlier job, per worker
+    '''
+    n_jobs = max(n_jobs, 1)
+    # spawn rather than fork so every worker starts its own R session
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp.get_context('spawn')) as pool:
+        submitted = deque()
+        for job in jobs:
+            submitted.append(pool.submit(compute_job, *job))
+            # bound the number of expression blocks held in memory
+            running = [fut for fut in submitted if not fut.done()]
+            if len(running) >= 2 * n_jobs:
+                wait(running, return_when=FIRST_COMPLETED)
+            # and the number of results waiting for a slow earlier job
+            if len(submitted) >= max_ahead * n_jobs:
+                submitted[0].result()
+            while submitted and submitted[0].done():
+                record(*submitted.popleft().result())
+        while submitted:
+            record(*submitted.popleft().result())
 
 
 # %%
-def run_compute_sigs(species: str, version: str, base_path: str = ""):
-    os.makedirs(f'out/data_{species}_{version}', exist_ok=True)
+def run_compute_sigs(species: str, version: str, base_path: str = "", jobs: int = 1, retry_failed: bool = False):
     with open(f'out/partitions/gse_groupings_{species}_{version}.json') as fr:
         gse_groupings = json.load(fr)
 
     f = h5.File(base_path + species+"_gene_v"+version+".h5", "r")
-    gse_scprob = np.array([
-        f["meta"]["samples"]["series_id"], 
-        f["meta"]["samples"]["geo_accession"],
-        f["meta"]["samples"]["singlecellprobability"],
-        f["meta"]["samples"]["title"],
-        f["meta"]["samples"]["characteristics_ch1"],
-        f["meta"]["samples"]["source_name_ch1"],
-    ]).T
-
-    genes = [x.decode('UTF-8') for x in f['meta/genes/symbol']]
-    samples = [x.decode('UTF-8') for x in f['meta/samples/geo_accession']] #GSMs
-
+    reader = ExpressionReader(f)
     # %%
-    samps_df = pd.DataFrame(gse_scprob, columns =['gse', 'gsm', 'scprob', 'title','characteristics_ch1', 'source_name_ch1'])
-    samps_df = samps_df[samps_df['scprob'] < .5]
-    samps_df['gse'] = samps_df['gse'].apply(lambda s: s.decode("utf-8"))
-    samps_df['gsm'] = samps_df['gsm'].apply(lambda s: s.decode("utf-8"))
-    samps_df['title'] = samps_df['title'].apply(lambda s: s.decode("utf-8"))
-    samps_df['characteristics_ch1'] = samps_df['characteristics_ch1'].apply(lambda s: s.decode("utf-8"))
-    samps_df['source_name_ch1'] = samps_df['source_name_ch1'].apply(lambda s: s.decode("utf-8"))
+    tokens = load_sample_tokens(species, version, base_path)
 
     # %%
-    gses = list(gse_groupings.keys())
-    for gse in tqdm(gses):
-        study_gsms_lists = list(gse_groupings[gse].values())
-        study_gsms = []
-        [study_gsms.extend(el) for el in study_gsms_lists] 
-        samples_idx = sorted([(i, x) for i, x in enumerate(samples) if x in study_gsms])
-        ordered_gsms = list(map(lambda t: t[1], samples_idx))
-        ordered_idx = list(map(lambda t: t[0], samples_idx))
+    # plan every comparison once, anything already in the signature store is done
+    store = SignatureStore(f'out/signatures_{species}_{version}.h5', genes=reader.genes)
+    queue = SignatureQueue(f'out/sig_queue_{species}_{version}.jsonl')
+    planned = queue.planned()
+    for gse in tqdm(gse_groupings, desc='Planning comparisons...'):
+        if gse in planned:
+            continue
         try:
-            expression_data = f['data/expression'][:, ordered_idx]  
-            expr_df = pd.DataFrame(data=expression_data, index=genes, columns=ordered_gsms, dtype=int).dropna()
-            groupings = gse_groupings[gse]
-            gse_table = samps_df[samps_df['gse'] == gse]
-            gse_table['combined'] = gse_table['title'] + ' _ ' +  gse_table['characteristics_ch1'] + ' _ ' +  gse_table['source_name_ch1']
-            compute_sigs(expr_df, groupings, species, gse, gse_table, version)
-        except:
-            print("error extracting counts from ARCHS4 for", gse)
-    f.close()
+            comparisons = plan_comparisons(gse_groupings[gse], species, gse, tokens)
+        except Exception:
+            print("error labeling conditions for", gse)
+            continue
+        for sig_name, samps, samps2 in comparisons:
+            status = 'done' if sig_name in store else 'pending'
+            queue.add(gse, sig_name, samps, samps2, status=status)
+
+    pending = queue.pending(retry_failed=retry_failed)
+    study_gsms = {
+        gse: [gsm for gsms in gse_groupings[gse].values() for gsm in gsms]
+        for gse in pending
+    }
+
+    def iter_jobs():
+        for gse, ordered_gsms, expression_data in tqdm(reader.iter_groups(study_gsms), total=len(study_gsms)):
+            try:
+                expr_df = pd.DataFrame(data=expression_data, index=reader.genes, columns=ordered_gsms, dtype=int).dropna()
+            except:
+                print("error extracting counts from ARCHS4 for", gse)
+                continue
+            for sig_name, samps, samps2 in pending[gse]:
+                try:
+                    ctrl_df, case_df = expr_df[samps], expr_df[samps2]
+                except KeyError as e:
+                    queue.record(sig_name, 'failed', f'missing samples {e}')
+                    continue
+                yield sig_name, ctrl_df, case_df
 
+    def record(sig_name, status, error, dge):
+        if status == 'done':
+            # signatures are only marked done once the store has written them to disk
+            for flushed in store.append(sig_name, dge):
+                queue.record(flushed, 'done')
+        else:
+            queue.record(sig_name, status, error)
+
+    try:
+        run_jobs(iter_jobs(), record, n_jobs=jobs)
+    finally:
+        for flushed in store.flush():
+            queue.record(flushed, 'done')
+        store.close()
+        queue.close()
+        f.close()
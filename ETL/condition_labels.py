@@ -0,0 +1,115 @@
+import os
+import re
+import json
+import hashlib
+import threading
+import pandas as pd
+from functools import lru_cache
+from samples_meta import load_samples_meta
+
+import nltk
+from nltk.corpus import stopwords
+nltk.download('stopwords')
+
+# condition titles of the processed metadata (create_meta_dict.py)
+title_words_to_remove = ['experiement', 'experiment', 'patient', 'batch', 'tissue', 'cell type', 'cel type:', 'treatment', 'genotype', 'time point', 'animal', 'datatype']
+title_stopwords = sorted(set(stopwords.words('english') + title_words_to_remove))
+# condition labels used to find the controls of a comparison (compute_signatures.py)
+comparison_words_to_remove = ['experiement', 'tissue:', 'type:', 'batch:', 'treatment:', 'experiment', 'patient', 'batch', '1', '2', '3', '4', '5', '6', '7', '8', '9']
+comparison_stopwords = set(stopwords.words('english') + comparison_words_to_remove)
+
+_spaces = re.compile(r'\s+')
+_title_separators = re.compile(r',|-|:|;|_')
+_comparison_separators = re.compile(r'[-,_.:]')
+# bump when the tokenization changes
+cache_version = 1
+
+
+@lru_cache(maxsize=None)
+def words_pattern(words_to_remove: tuple):
+    # Create a regular expression pattern using the words to remove, once per list of words
+    remove = '|'.join(words_to_remove)
+    return re.compile(r'\b('+remove+r')\b', flags=re.IGNORECASE)
+
+
+def title_tokens(samps_df: pd.DataFrame):
+    ''' Lower cased words of the title, characteristics and source of each sample, without
+    separators, stop words and repeated words
+    '''
+    text = (samps_df['title'] + ' ' + samps_df['characteristics_ch1'] + ' ' + samps_df['source_name_ch1']).astype(str).str.lower()
+    text = text.str.replace(_title_separators, ' ', regex=True)
+    # multi-word entries like "cell type" are removed as phrases
+    text = text.str.replace(words_pattern(tuple(title_stopwords)), '', regex=True)
+    text = text.str.replace(_spaces, ' ', regex=True).str.strip()
+    return [' '.join(dict.fromkeys(s.split())) for s in text]
+
+
+def comparison_tokens(samps_df: pd.DataFrame):
+    ''' Like `title_tokens` with the separators and stop words used to label comparisons
+    '''
+    text = (samps_df['title'] + ' _ ' + samps_df['characteristics_ch1'] + ' _ ' + samps_df['source_name_ch1']).astype(str).str.lower()
+    text = text.str.replace(_comparison_separators, ' ', regex=True)
+    return [' '.join(dict.fromkeys(w for w in s.split() if w not in comparison_stopwords)) for s in text]
+
+
+tokenizers = {
+    'title': title_tokens,
+    'comparison': comparison_tokens,
+}
+
+
+def common_tokens(token_lists):
+    ''' The tokens of the first list found in every other list, in their order in the first list
+    '''
+    first = token_lists[0]
+    common = set(first).intersection(*token_lists[1:])
+    return [token for token in first if token in common]
+
+
+class SampleTokens:
+    ''' The tokens of every grouped sample of a release, for each of `tokenizers`
+    '''
+    def __init__(self, frame: pd.DataFrame):
+        self.tokens = {kind: dict(zip(frame['gsm'], frame[kind])) for kind in tokenizers}
+
+    def get(self, kind: str, gsm: str):
+        return self.tokens[kind][gsm].split()
+
+    def label(self, kind: str, gsms):
+        ''' The condition label of a group of samples, the tokens they all share
+        '''
+        return ' '.join(common_tokens([self.get(kind, gsm) for gsm in gsms]))
+
+
+_build_lock = threading.Lock()
+
+def load_sample_tokens(species: str, version: str, base_path: str = "", cache_dir: str = 'out/cache'):
+    ''' Tokenize the metadata of every sample in the release groupings in one pass. The tokens
+    are cached as parquet keyed by the HDF5 file, the groupings and the release version, so the
+    metadata and signature stages of a release share a single tokenization.
+    '''
+    file = f'{base_path}{species}_gene_v{version}.h5'
+    groupings = f'out/partitions/gse_groupings_{species}_{version}.json'
+    with open(groupings, 'rb') as f:
+        groupings_hash = hashlib.sha1(f.read()).hexdigest()
+    key = hashlib.sha1(json.dumps([
+        os.path.abspath(file), os.path.getmtime(file), groupings_hash, version, cache_version,
+    ]).encode()).hexdigest()[:12]
+    cache = f'{cache_dir}/sample_tokens_{species}_{version}_{key}.parquet'
+    # stages running side by side in the release pipeline wait for the first one to tokenize
+    with _build_lock:
+        if os.path.exists(cache):
+            return SampleTokens(pd.read_parquet(cache))
+
+        with open(groupings) as f:
+            gse_groupings = json.load(f)
+        samps_df = load_samples_meta(species, version, base_path)
+        samps_df = samps_df[(samps_df['scprob'] < .5) & samps_df['gse'].isin(gse_groupings.keys())]
+        frame = pd.DataFrame({'gsm': samps_df['gsm'].values})
+        for kind, tokenize in tokenizers.items():
+            frame[kind] = tokenize(samps_df)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        frame.to_parquet(cache + '.tmp', index=False)
+        os.replace(cache + '.tmp', cache)
+        return SampleTokens(frame)
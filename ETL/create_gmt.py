@@ -1,50 +1,113 @@
-import pandas as pd
 import os
+import gzip
+import multiprocessing as mp
+import numpy as np
 from tqdm import tqdm
+from signature_store import SignatureStore
 
 
-def create_gmt(species: str, version: str):
-    num_gs =0
+def select_genes(t, adj_p, up: bool, max_genes: int = 2000):
+    ''' Mask of the significant genes in one direction for a block of signatures (rows).
+    When a signature has more than `max_genes`, its adjusted p-value cutoff is tightened
+    (0.05, 0.01, 0.005, 0.0005, ...) until at most `max_genes` remain, all rows at once.
+    '''
+    p = np.where(t > 0 if up else t < 0, adj_p, np.nan)
+    # cutoffs are compared in the precision of the p-values, the store keeps float32
+    cutoffs = np.array([0.05, 0.01] + [0.05 * 10.0**(-i) for i in range(1, 400)], dtype=p.dtype)
+    step = np.zeros(len(p), dtype=int)
+    counts = (p < cutoffs[step, None]).sum(1)
+    over = counts > max_genes
+    while over.any():
+        step[over] += 1
+        counts[over] = (p[over] < cutoffs[step[over], None]).sum(1)
+        over = counts > max_genes
+    return p < cutoffs[step, None]
+
+
+def gene_set_lines(names, genes, t, adj_p, by_significance: bool = False):
+    ''' The up and down GMT lines of a block of signatures
+    :param by_significance: Order the genes of each set by adjusted p-value rather than `genes` order
+    '''
+    lines = []
+    masks = {direction: select_genes(t, adj_p, up) for direction, up in (('up', True), ('dn', False))}
+    for i, signame in enumerate(names):
+        for direction, mask in masks.items():
+            selected = np.flatnonzero(mask[i])
+            if len(selected) < 5:
+                continue
+            if by_significance:
+                selected = selected[np.argsort(adj_p[i, selected], kind='stable')]
+            genes_str = '\t'.join(genes[selected])
+            lines.append(f"{signame} {direction}\t\t{genes_str}\n")
+    return lines
+
+
+_store = None
+
+def _open_store(path: str):
+    global _store
+    _store = SignatureStore(path, mode='r')
+
+
+def store_block_lines(block):
+    ''' GMT lines of signatures `start:stop` of the store opened by this worker
+    '''
+    start, stop = block
+    values = _store.block(start, stop, fields=('t', 'adj.P.Val'))
+    # the store keeps genes in a fixed order, list them from most to least significant instead
+    return gene_set_lines(_store.names[start:stop], np.array(_store.genes, dtype=object), values['t'], values['adj.P.Val'], by_significance=True)
+
+
+def read_signature(path: str):
+    ''' Read the gene symbols, t statistics and adjusted p-values of a signature file
+    '''
+    with gzip.open(path, 'rt') as fr:
+        header = fr.readline().rstrip('\n').split('\t')
+        t_col, p_col = header.index('t'), header.index('adj.P.Val')
+        genes, t, adj_p = [], [], []
+        for line in fr:
+            fields = line.rstrip('\n').split('\t')
+            genes.append(fields[0])
+            t.append(fields[t_col])
+            adj_p.append(fields[p_col])
+    return np.array(genes, dtype=object), np.array(t, dtype=float), np.array(adj_p, dtype=float)
+
+
+def signature_file_lines(path: str):
+    ''' GMT lines of a single `<signame>.tsv.gz` file, as written by earlier releases
+    '''
+    signame = os.path.basename(path).replace('.tsv.gz', '')
+    try:
+        genes, t, adj_p = read_signature(path)
+    except Exception as e:
+        print(signame, e)
+        return []
+    return gene_set_lines([signame], genes, t[None, :], adj_p[None, :])
+
+
+def create_gmt(species: str, version: str, jobs: int = None, block_size: int = 256):
+    num_gs = 0
     os.makedirs('out/gmts', exist_ok=True)
-    sig_files = os.listdir(f'out/data_{species}_{version}')
-    with open(f'out/gmts/{species}-geo-auto_{version}.gmt', 'a') as f:
-        for signame in tqdm(list(sig_files)):
-            try:
-                sig = pd.read_csv(f'data_{species}_{version}/{signame}', index_col=0, sep='\t', compression='gzip')
-                sig_signif = sig[sig['adj.P.Val'] < .05]
-
-                genes_up = sig_signif[sig_signif['t'] > 0].index.values
-
-                if len(genes_up) > 2000:
-                    sig_signif_up = sig_signif[sig_signif['t'] > 0]
-                    cutoff = 0.01
-                    i = 1
-                    while len(genes_up) > 2000:
-                        genes_up = sig_signif_up[sig_signif_up['adj.P.Val'] < cutoff].index.values
-                        cutoff = 0.05 * 10**(-i)
-                        i += 1
-
-                genes_down = sig_signif[sig_signif['t'] < 0].index.values
-
-                if len(genes_down) > 2000:
-                    sig_signif_dn = sig_signif[sig_signif['t'] < 0]
-                    cutoff = 0.01
-                    i = 1
-                    while len(genes_down) > 2000:
-                        genes_down = sig_signif_dn[sig_signif_dn['adj.P.Val'] < cutoff].index.values
-                        cutoff = 0.05 * 10**(-i)
-                        i += 1
-                if len(genes_up) >= 5:
-                    genes_up_str = '\t'.join(genes_up)
-                    f.write(f"{signame.replace('.tsv.gz', '')} up\t\t{genes_up_str}\n")
-                    num_gs+=1
-                #else: print(sig_signif, len(genes_up), genes_up)
-                if len(genes_down) >= 5:
-                    genes_down_str = '\t'.join(genes_down)
-                    f.write(f"{signame.replace('.tsv.gz', '')} dn\t\t{genes_down_str}\n")
-                    num_gs+=1
-                #else: print(sig_signif, len(genes_down), genes_down)
-            except Exception as e:
-                print(sig, e)
+    gmt = f'out/gmts/{species}-geo-auto_{version}.gmt'
+    store_path = f'out/signatures_{species}_{version}.h5'
+    if os.path.exists(store_path):
+        with SignatureStore(store_path, mode='r') as store:
+            n_sigs = len(store)
+        tasks = [(start, min(start + block_size, n_sigs)) for start in range(0, n_sigs, block_size)]
+        pool = mp.get_context('spawn').Pool(jobs, initializer=_open_store, initargs=(store_path,))
+        func, chunksize = store_block_lines, 1
+    else:
+        sig_dir = f'out/data_{species}_{version}'
+        # sorted so the GMT comes out in the same order on every run
+        tasks = [f'{sig_dir}/{signame}' for signame in sorted(os.listdir(sig_dir)) if signame.endswith('.tsv.gz')]
+        pool = mp.get_context('spawn').Pool(jobs)
+        func, chunksize = signature_file_lines, 64
+    # workers are spawned rather than forked, other stages of the release pipeline may be
+    #  running in this process and holding the h5py or stdio locks
+    with pool, open(gmt + '.tmp', 'w') as f:
+        for lines in tqdm(pool.imap(func, tasks, chunksize=chunksize), total=len(tasks)):
+            f.writelines(lines)
+            num_gs += len(lines)
+    os.replace(gmt + '.tmp', gmt)
 
     print("Exported", num_gs, "gene sets.")
@@ -0,0 +1,92 @@
+import os
+import json
+import hashlib
+import numpy as np
+from tqdm import tqdm
+
+
+class EmbeddingStore:
+    ''' Persistent cache of sentence embeddings shared across GSEs, species and releases.
+
+    Vectors are appended to a float32 matrix on disk which is read back memory-mapped,
+     rows are looked up by the sha1 of the sentence. Sentences not yet in the store are
+     embedded together in large batches rather than one GSE at a time.
+    :param encode: A function embedding a list of sentences into a 2d array
+    :param model_name: Name of the model, each model gets its own store
+    :param chunk_size: Number of new sentences embedded and flushed to disk at a time
+    '''
+    def __init__(self, encode, model_name: str, path: str = 'out/cache/embeddings', chunk_size: int = 4096):
+        self.encode = encode
+        self.chunk_size = chunk_size
+        self.dir = f'{path}/{model_name}'
+        self.vectors_path = f'{self.dir}/vectors.f32'
+        self.index_path = f'{self.dir}/index.txt'
+        self.meta_path = f'{self.dir}/meta.json'
+        os.makedirs(self.dir, exist_ok=True)
+
+        self.dim = None
+        self.index = {}
+        self._vectors = None
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as fr:
+                self.dim = json.load(fr)['dim']
+        if self.dim is not None and os.path.exists(self.index_path):
+            with open(self.index_path) as fr:
+                keys = [key for key in fr.read().split('\n') if len(key) == 40]
+            # an interrupted write can leave the two files out of step, keep the rows present in both
+            n = min(len(keys), len(self))
+            if n != len(keys) or n * self.dim * 4 != self._size():
+                if os.path.exists(self.vectors_path):
+                    os.truncate(self.vectors_path, n * self.dim * 4)
+                with open(self.index_path, 'w') as fw:
+                    fw.writelines(key + '\n' for key in keys[:n])
+            for i, key in enumerate(keys[:n]):
+                self.index.setdefault(key, i)
+
+    @staticmethod
+    def key(sentence: str):
+        return hashlib.sha1(sentence.encode('utf-8')).hexdigest()
+
+    def _size(self):
+        return os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+
+    def __len__(self):
+        return self._size() // (self.dim * 4) if self.dim else 0
+
+    @property
+    def vectors(self):
+        if self._vectors is None:
+            self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(len(self), self.dim))
+        return self._vectors
+
+    def add(self, sentences):
+        ''' Embed and store the sentences which are not in the store yet
+        '''
+        missing = list(dict.fromkeys(s for s in sentences if self.key(s) not in self.index))
+        if not missing:
+            return
+        for i in tqdm(range(0, len(missing), self.chunk_size), desc='Embedding new sentences...'):
+            chunk = missing[i:i+self.chunk_size]
+            self._append(chunk, np.asarray(self.encode(chunk), dtype=np.float32))
+
+    def get(self, sentences):
+        ''' Return the embeddings of `sentences` as a 2d array, embedding any missing ones
+        '''
+        self.add(sentences)
+        return np.array(self.vectors[[self.index[self.key(s)] for s in sentences]])
+
+    def _append(self, sentences, vectors):
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            with open(self.meta_path, 'w') as fw:
+                json.dump({'dim': self.dim}, fw)
+        n = len(self)
+        keys = [self.key(s) for s in sentences]
+        # vectors first so a crash leaves at worst rows without keys, which are dropped on load
+        with open(self.vectors_path, 'ab') as fw:
+            fw.write(vectors.tobytes())
+        with open(self.index_path, 'a') as fw:
+            fw.writelines(key + '\n' for key in keys)
+        for i, key in enumerate(keys):
+            self.index.setdefault(key, n + i)
+        self._vectors = None
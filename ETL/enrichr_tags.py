@@ -1,63 +1,260 @@
 #%%
 import os
 import json
+import hashlib
+import numpy as np
+import scipy.sparse as sp
+from scipy.stats import hypergeom
 from tqdm import tqdm
-from maayanlab_bioinformatics.enrichment import enrich_crisp
 import multiprocessing as mp
-from statsmodels.stats.multitest import multipletests
-import pyenrichr as pye
 
 libraries = [
      'ChEA_2022', 'KEGG_2021_Human', 'WikiPathway_2023_Human', 'GO_Biological_Process_2023', 'MGI_Mammalian_Phenotype_Level_4_2021', 'Human_Phenotype_Ontology', 'GWAS_Catalog_2023']
-loadedLibs = {
-}
+background_size = 21000
+min_set_size = 5
+min_overlap = 2
 
 #%%
-for l in libraries:
-    lib = {}
-    with open(f'enrichr_libs/{l}.txt') as f:
-        lines = f.readlines()
-    for line in lines:
-        split_line = line.replace('\n', '').split('\t')
-        lib[split_line[0]] = set(split_line[2:])
-    loadedLibs[l] = lib
-
-fisher = pye.enrichment.FastFisher(34000)
-
-def get_enrichr_labels(term, gene_list, loadedLibs = loadedLibs):
-    enrichr_results = {}   
-    term = term[0]
-    enrichr_results[term] = {}
-    gene_list = [g.upper() for g in gene_list]
-    for lib in libraries:
-        enrich_res = pye.enrichment.fisher(gene_list, loadedLibs[lib], fisher=fisher, background_size=21000)
-        sig_enrich_res = enrich_res[enrich_res['fdr'] < 0.05]
-
-        if len(sig_enrich_res) == 0:
-            enrichr_results[term][lib] = []
-            continue
-        sig_enrich_res.reset_index(drop=True, inplace=True)
-        enriched_term = []
-        for i, r in sig_enrich_res.iterrows():
-            enriched_term.append([r['term'], r['p-value'], r['fdr'], r['odds'], r['overlap']])
-            if i == 2:
-                break
-        enrichr_results[term][lib] = enriched_term
+def load_libraries(libraries=libraries, path: str = 'enrichr_libs'):
+    ''' Load the libraries once as sparse term x gene matrices over a gene index shared by all of them
+    :return: The gene index and, per library, its terms, term sizes and genes x terms matrix
+    '''
+    raw = {}
+    for l in libraries:
+        lib = {}
+        with open(f'{path}/{l}.txt') as f:
+            for line in f:
+                split_line = line.replace('\n', '').split('\t')
+                lib[split_line[0]] = set(split_line[2:])
+        raw[l] = lib
+    gene_index = {
+        gene: i
+        for i, gene in enumerate(sorted({gene for lib in raw.values() for genes in lib.values() for gene in genes}))
+    }
+    loaded_libs = {}
+    for l, lib in raw.items():
+        rows = [i for i, genes in enumerate(lib.values()) for _ in genes]
+        cols = [gene_index[gene] for genes in lib.values() for gene in genes]
+        matrix = sp.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(len(lib), len(gene_index)))
+        loaded_libs[l] = dict(
+            terms=list(lib),
+            sizes=np.array([len(genes) for genes in lib.values()]),
+            genes_x_terms=matrix.T.tocsr(),
+        )
+    return gene_index, loaded_libs
+
+
+def fdr_bh(p):
+    ''' Benjamini-Hochberg adjusted p-values of each row of `p`, NaNs are not tested
+    '''
+    m = np.sum(~np.isnan(p), axis=1, keepdims=True)
+    order = np.argsort(p, axis=1, kind='stable')
+    sorted_p = np.take_along_axis(p, order, axis=1)
+    q = sorted_p * m / np.arange(1, p.shape[1] + 1)[None, :]
+    q = np.where(np.isnan(q), np.inf, q)
+    q = np.minimum(np.minimum.accumulate(q[:, ::-1], axis=1)[:, ::-1], 1)
+    fdr = np.empty_like(q)
+    np.put_along_axis(fdr, order, q, axis=1)
+    return np.where(np.isnan(p), np.nan, fdr)
+
+
+def get_enrichr_labels(terms, gene_lists, gene_index, loaded_libs, top: int = 3):
+    ''' Significant Enrichr terms of a batch of gene sets against every library.
+    Overlaps come from one sparse matrix product per library, p-values (one-sided Fisher
+     exact test) and FDRs are computed for the whole batch at once.
+    :return: A list with, for each gene set, {term: {library: [[term, p-value, fdr, odds, overlap], ...]}}
+    '''
+    queries = [{g.upper() for g in gene_list} for gene_list in gene_lists]
+    l1 = np.array([len(query) for query in queries])[:, None]
+    rows = [i for i, query in enumerate(queries) for g in query if g in gene_index]
+    cols = [gene_index[g] for query in queries for g in query if g in gene_index]
+    queries_x_genes = sp.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(len(queries), len(gene_index)))
+
+    enrichr_results = [{term: {}} for term in terms]
+    for lib, loaded in loaded_libs.items():
+        a = (queries_x_genes @ loaded['genes_x_terms']).toarray()
+        l2 = loaded['sizes'][None, :]
+        relevant = (a >= min_overlap) & (l2 >= min_set_size)
+        ii, jj = np.nonzero(relevant)
+        # same contingency table as pyenrichr: b = l1 - a, c = l2 - a, d = background - b - c + a
+        p = np.full(a.shape, np.nan)
+        p[ii, jj] = hypergeom.sf(a[ii, jj] - 1, background_size + 2 * a[ii, jj], l1[ii, 0], l2[0, jj])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            odds = (a / l1) / (l2 / background_size)
+        fdr = fdr_bh(p)
+        order = np.argsort(np.where(relevant, p, np.inf), axis=1, kind='stable')
+        for i, term in enumerate(terms):
+            enriched_term = []
+            for j in order[i, :top]:
+                # fdr is monotone in p-value order, so stop at the first non significant term
+                if not relevant[i, j] or not fdr[i, j] < 0.05:
+                    break
+                enriched_term.append([loaded['terms'][j], float(p[i, j]), float(fdr[i, j]), float(odds[i, j]), int(a[i, j])])
+            enrichr_results[i][term][lib] = enriched_term
     return enrichr_results
 
 
-def compute_enrichr_labels(species: str, version: str):
-        gene_lists = []
-        terms = []
-        with open(f'out/gmts/{species}-geo-auto_{version}.gmt') as fr:
-            lines = fr.readlines()
-        for l in tqdm(lines):
-            l = l.replace('\n', '')
-            split_line = l.split('\t')
-            terms.append((split_line[0], split_line[1]))
+def fingerprint_library(l: str, path: str = 'enrichr_libs'):
+    ''' Hash of a library file and the scoring parameters, results are reused only while both are unchanged
+    '''
+    h = hashlib.sha1(f'{background_size}:{min_set_size}:{min_overlap}\n'.encode())
+    with open(f'{path}/{l}.txt', 'rb') as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+
+def fingerprint_genes(gene_list):
+    return hashlib.sha1('\t'.join(sorted({g.upper() for g in gene_list})).encode()).hexdigest()
+
+
+def load_manifest(path: str):
+    ''' Fingerprints of previously scored signatures: {term: {'genes': fingerprint, 'libraries': {library: fingerprint}}}
+    '''
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        manifest = json.load(f)
+    # entries of manifests which also held the results are rescored once into the JSONL
+    return {term: entry for term, entry in manifest.items() if 'libraries' in entry}
+
+
+def save_manifest(manifest: dict, path: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
+
+
+class EnrichrResults:
+    ''' Append-only JSONL of the Enrichr terms of each signature, a record per signature scored
+     against some libraries: {'term', 'genes': fingerprint, 'results': {library: {'library': fingerprint, 'terms': [...]}}}
+    Only the results matching the fingerprints of the manifest are loaded, later records win.
+    :param terms: Signatures to load the results of
+    '''
+    def __init__(self, path: str, manifest: dict, terms):
+        self.path = path
+        self.results = {}
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        terms = set(terms)
+        torn = False
+        if os.path.exists(path):
+            with open(path) as fr:
+                for line in fr:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # the last line may be torn if the previous run was killed
+                        torn = not line.endswith('\n')
+                        continue
+                    entry = manifest.get(record['term'])
+                    if record['term'] not in terms or entry is None or entry['genes'] != record['genes']:
+                        continue
+                    for l, result in record['results'].items():
+                        if entry['libraries'].get(l) == result['library']:
+                            self.results.setdefault(record['term'], {})[l] = result['terms']
+        self.fw = open(path, 'a')
+        if torn:
+            self.fw.write('\n')
+
+    def put(self, term: str, genes: str, results: dict):
+        ''' Record the results of a signature, {library: (fingerprint, terms)}
+        '''
+        self.results.setdefault(term, {}).update({l: terms for l, (_, terms) in results.items()})
+        self.fw.write(json.dumps(dict(term=term, genes=genes, results={
+            l: {'library': fp, 'terms': terms} for l, (fp, terms) in results.items()
+        })) + '\n')
+        self.fw.flush()
+
+    def close(self):
+        self.fw.close()
+
+
+_libs = None
+
+def _init_worker(libs):
+    global _libs
+    _libs = libs
+
+
+def _get_enrichr_labels_chunk(chunk):
+    terms, gene_lists, libs = chunk
+    gene_index, loaded_libs = _libs
+    return get_enrichr_labels(terms, gene_lists, gene_index, {l: loaded_libs[l] for l in libs})
+
+
+def read_gmt(gmt: str):
+    ''' The terms and gene lists of a GMT file
+    '''
+    terms, gene_lists = [], []
+    with open(gmt) as fr:
+        for l in fr:
+            split_line = l.replace('\n', '').split('\t')
+            terms.append(split_line[0])
             gene_lists.append(split_line[2:])
-        results = []
-        for term, gene_list in tqdm(zip(terms, gene_lists), total=len(terms)):
-            results.append(get_enrichr_labels(term, gene_list))
-        with open(f'out/enrichr_terms_{species}_{version}.json', 'w') as f:
-            json.dump(results, f)
\ No newline at end of file
+    return terms, gene_lists
+
+
+def compute_enrichr_labels(species: str, version: str, jobs: int = None, chunk_size: int = 500, incremental: bool = False):
+        ''' Score the signatures of the release GMT against every library.
+        Results are appended per signature to a JSONL file per species as they are scored, and a manifest
+         keeps the fingerprints of the gene set and libraries they were computed from. With `incremental`,
+         only new or changed signatures and updated libraries are scored, everything else is taken from the
+         JSONL, and the release JSON is merged rather than rewritten.
+        '''
+        gmt = f'out/gmts/{species}-geo-auto_{version}.gmt'
+        out = f'out/enrichr_terms_{species}_{version}.json'
+        manifest_path = f'out/cache/enrichr_manifest_{species}.json'
+        terms, gene_lists = read_gmt(gmt)
+        manifest = load_manifest(manifest_path)
+        lib_fingerprints = {l: fingerprint_library(l) for l in libraries}
+        gene_fingerprints = dict(zip(terms, map(fingerprint_genes, gene_lists)))
+        cache = EnrichrResults(f'out/cache/enrichr_results_{species}.jsonl', manifest, terms)
+
+        # group signatures by the libraries they still have to be scored against
+        stale = {}
+        for i, term in enumerate(terms):
+            entry = manifest.get(term)
+            if not incremental or entry is None or entry['genes'] != gene_fingerprints[term]:
+                todo = tuple(libraries)
+            else:
+                todo = tuple(
+                    l for l in libraries
+                    if entry['libraries'].get(l) != lib_fingerprints[l] or l not in cache.results.get(term, {})
+                )
+            if todo:
+                stale.setdefault(todo, []).append(i)
+        tasks = [
+            ([terms[i] for i in idx[k:k+chunk_size]], [gene_lists[i] for i in idx[k:k+chunk_size]], todo)
+            for todo, idx in stale.items()
+            for k in range(0, len(idx), chunk_size)
+        ]
+        n_pairs = sum(len(todo) * len(idx) for todo, idx in stale.items())
+        print(f'Scoring {n_pairs} of {len(terms) * len(libraries)} signature x library pairs')
+
+        if tasks:
+            stale_libs = [l for l in libraries if any(l in todo for todo in stale)]
+            try:
+                # spawn rather than fork, other stages of the release pipeline may be running in this process
+                with mp.get_context('spawn').Pool(jobs, initializer=_init_worker, initargs=(load_libraries(stale_libs),)) as pool:
+                    for chunk_results in tqdm(pool.imap_unordered(_get_enrichr_labels_chunk, tasks), total=len(tasks)):
+                        for result in chunk_results:
+                            for term, scored in result.items():
+                                cache.put(term, gene_fingerprints[term], {l: (lib_fingerprints[l], enriched_terms) for l, enriched_terms in scored.items()})
+                                if manifest.get(term, {}).get('genes') != gene_fingerprints[term]:
+                                    manifest[term] = {'genes': gene_fingerprints[term], 'libraries': {}}
+                                manifest[term]['libraries'].update({l: lib_fingerprints[l] for l in scored})
+            finally:
+                # keep what was scored so an interrupted run picks up from there
+                save_manifest(manifest, manifest_path)
+        cache.close()
+
+        results = {}
+        if incremental and os.path.exists(out):
+            with open(out) as f:
+                for r in json.load(f):
+                    results.update(r)
+        for term in terms:
+            results[term] = {l: cache.results[term][l] for l in libraries}
+        with open(out + '.tmp', 'w') as f:
+            json.dump([{term: r} for term, r in results.items()], f)
+        os.replace(out + '.tmp', out)
@@ -0,0 +1,69 @@
+from collections import OrderedDict
+import numpy as np
+from samples_meta import read_strings
+
+
+class ExpressionReader:
+    ''' Column-blocked access to the ARCHS4 `data/expression` matrix.
+
+    Requested GSM columns are grouped by the HDF5 chunk (column block) they live in,
+     each block is read once with a contiguous slice and decoded blocks are kept in a
+     bounded LRU cache so neighbouring GSEs sharing a block do not hit the disk again.
+    :param f: An open h5py.File of an ARCHS4 release
+    :param cache_bytes: Upper bound on the memory used by cached blocks
+    '''
+    def __init__(self, f, dataset: str = 'data/expression', cache_bytes: int = 2 * 1024**3):
+        self.dset = f[dataset]
+        self.n_genes, self.n_samples = self.dset.shape
+        self.block_width = self.dset.chunks[1] if self.dset.chunks else 1024
+        block_bytes = self.n_genes * self.block_width * self.dset.dtype.itemsize
+        self.max_blocks = max(1, cache_bytes // block_bytes)
+        self._cache = OrderedDict()
+
+        self.genes = list(read_strings(f['meta/genes/symbol']))
+        self.samples = list(read_strings(f['meta/samples/geo_accession'])) #GSMs
+        self.sample_index = {}
+        for i, gsm in enumerate(self.samples):
+            self.sample_index.setdefault(gsm, i)
+
+    def block(self, b: int):
+        ''' Return column block `b`, reading it from disk only if it is not cached
+        '''
+        if b in self._cache:
+            self._cache.move_to_end(b)
+            return self._cache[b]
+        start = b * self.block_width
+        stop = min(start + self.block_width, self.n_samples)
+        data = self.dset[:, start:stop]
+        self._cache[b] = data
+        if len(self._cache) > self.max_blocks:
+            self._cache.popitem(last=False)
+        return data
+
+    def columns(self, idx):
+        ''' Gather the columns `idx` (in the given order) into a dense genes x samples array
+        '''
+        idx = np.asarray(idx, dtype=np.int64)
+        out = np.empty((self.n_genes, len(idx)), dtype=self.dset.dtype)
+        blocks = idx // self.block_width
+        for b in np.unique(blocks):
+            positions = np.flatnonzero(blocks == b)
+            out[:, positions] = self.block(int(b))[:, idx[positions] - b * self.block_width]
+        return out
+
+    def iter_groups(self, groups: dict):
+        ''' Yield `(key, gsms, data)` for each group of GSMs, e.g. the samples of a GSE.
+        Groups are visited in order of the column blocks they touch so the matrix is
+         read in a single sequential pass; `gsms` are returned in file order and
+         GSMs missing from the release are dropped.
+        :param groups: A mapping from a key to the list of GSMs to gather
+        '''
+        resolved = []
+        for key, gsms in groups.items():
+            idx = sorted({self.sample_index[gsm] for gsm in gsms if gsm in self.sample_index})
+            if not idx:
+                continue
+            resolved.append((idx[0] // self.block_width, idx[-1] // self.block_width, key, idx))
+        resolved.sort(key=lambda t: (t[0], t[1]))
+        for _, _, key, idx in resolved:
+            yield key, [self.samples[i] for i in idx], self.columns(idx)
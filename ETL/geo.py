@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import sqlite3
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+from llm import TokenBucket, backoff
+
+# shared by the ETL, the database ingest and the figures regardless of the working directory
+default_cache_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'geo', 'gse_meta.sqlite')
+
+
+def parse_soft_header(text: str):
+    ''' The `!Series_*` fields of a SOFT series record, as a mapping from field to its list of values
+    '''
+    meta = {}
+    for line in text.splitlines():
+        if not line.startswith('!Series_'):
+            continue
+        field, _, value = line[len('!Series_'):].partition(' = ')
+        meta.setdefault(field.strip(), []).append(value.strip())
+    return meta
+
+
+def series_attribute(meta: dict, attr: str):
+    ''' A field like GEOparse's `get_metadata_attribute`: the value when there is one, the list
+    when there are several and None when it is missing
+    '''
+    values = meta.get(attr)
+    if not values:
+        return None
+    return values[0] if len(values) == 1 else values
+
+
+def series_info(meta: dict):
+    ''' The title, summary, PubMed ID, publication date and platform of a series
+    '''
+    date_object = datetime.strptime(series_attribute(meta, 'status'), "Public on %b %d %Y")
+    return dict(
+        title=series_attribute(meta, 'title'),
+        summary=series_attribute(meta, 'summary'),
+        pmid=series_attribute(meta, 'pubmed_id'),
+        publication_date=date_object.strftime("%Y-%m-%d"),  # yyyy-mm-dd
+        platform=series_attribute(meta, 'platform_id'),
+    )
+
+
+class GEOClient:
+    ''' Fetches the header of GEO series records, without their samples and platforms.
+
+    Only the brief SOFT view of each series is downloaded and only its `!Series_*` fields are
+     kept, in a SQLite cache shared by every caller, so a series is fetched once across the ETL,
+     the database ingest and the figures.
+    :param cache_path: Defaults to `data/geo/gse_meta.sqlite` at the root of the repository, or GEO_CACHE
+    :param base_url: The GEO accession viewer, set GEO_URL to use a local fixture server instead
+    :param jobs: Number of series fetched concurrently
+    :param rate: Maximum requests per second
+    '''
+    def __init__(self, cache_path: str = None, base_url: str = None, jobs: int = 4, rate: float = 3, max_retries: int = 5, timeout: float = 60):
+        self.cache_path = cache_path or os.getenv('GEO_CACHE', default_cache_path)
+        self.base_url = base_url or os.getenv('GEO_URL', 'https://www.ncbi.nlm.nih.gov/geo/query/acc.cgi')
+        self.jobs = jobs
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.bucket = TokenBucket(rate)
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=jobs))
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=jobs))
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        # several clients can share the cache, e.g. species ingested side by side: readers do not
+        #  block the writer and a writer waits for another one rather than failing
+        self.db = sqlite3.connect(self.cache_path, timeout=60)
+        self.db.execute('pragma journal_mode=wal')
+        with self.db:
+            self.db.execute('create table if not exists gse_meta (gse text primary key, meta text not null)')
+
+    def fetch(self, gse: str):
+        ''' Download and parse the header of one series, None if GEO does not know it
+        '''
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                response = self.session.get(self.base_url, params=dict(acc=gse, targ='self', form='text', view='brief'), timeout=self.timeout)
+                response.raise_for_status()
+            except requests.RequestException as e:
+                if attempt == self.max_retries:
+                    print(f'Failed to fetch {gse}: {e}')
+                    return None
+                time.sleep(backoff(attempt))
+                continue
+            meta = parse_soft_header(response.text)
+            return meta or None
+
+    def series(self, gses):
+        ''' Headers of `gses`, a mapping from GSE to {field: [values]}, series which could not be
+        fetched are left out
+        '''
+        gses = list(dict.fromkeys(gses))
+        cached = {}
+        for i in range(0, len(gses), 500):
+            batch = gses[i:i+500]
+            cached.update(
+                (gse, json.loads(meta))
+                for gse, meta in self.db.execute(f"select gse, meta from gse_meta where gse in ({','.join('?' * len(batch))})", batch)
+            )
+        missing = [gse for gse in gses if gse not in cached]
+        rows = []
+        def write():
+            # fetched rows are written together in a short transaction, the write lock is never held
+            #  while waiting on GEO
+            with self.db:
+                self.db.executemany('insert or replace into gse_meta (gse, meta) values (?, ?)', rows)
+            rows.clear()
+        try:
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                futures = {executor.submit(self.fetch, gse): gse for gse in missing}
+                for future in tqdm(as_completed(futures), total=len(futures), desc='Fetching GSE info...'):
+                    meta = future.result()
+                    if meta is None:
+                        continue
+                    cached[futures[future]] = meta
+                    rows.append((futures[future], json.dumps(meta)))
+                    if len(rows) >= 100:
+                        write()
+        finally:
+            write()
+        return {gse: cached[gse] for gse in gses if gse in cached}
+
+    def close(self):
+        self.db.close()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
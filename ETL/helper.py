@@ -1,7 +1,7 @@
 import click
-import psycopg2
-import traceback
 import typing as t
+if t.TYPE_CHECKING:
+  import psycopg2
 from pathlib import Path
 from tqdm import tqdm
 import json
@@ -9,12 +9,13 @@ import os
 
 FileDescriptor = t.Union[int, str]
 
-def copy_from_tsv(conn: 'psycopg2.connection', table: str, columns: list[str], r: FileDescriptor):
+def copy_from_tsv(conn: 'psycopg2.connection', table: str, columns: list[str], r: FileDescriptor, commit: bool = True):
   ''' Copy from a file descriptor into a postgres database table through as psycopg2 connection object
   :param con: The psycopg2.connect object
   :param r: An file descriptor to be opened in read mode
   :param table: The table top copy into
   :param columns: The columns being copied
+  :param commit: Commit once copied, pass False to leave it to the enclosing transaction
   '''
   import os
   with conn.cursor() as cur:
@@ -27,9 +28,10 @@ def copy_from_tsv(conn: 'psycopg2.connection', table: str, columns: list[str], r
         ''',
         file=fr,
       )
-    conn.commit()
+    if commit:
+      conn.commit()
 
-def copy_from_records(conn: 'psycopg2.connection', table: str, columns: list[str], records: t.Iterable[dict]):
+def copy_from_records(conn: 'psycopg2.connection', table: str, columns: list[str], records: t.Iterable[dict], commit: bool = True):
   ''' Copy from records into a postgres database table through as psycopg2 connection object.
   This is done by constructing a unix pipe, writing the records with csv writer
    into the pipe while loading from the pipe into postgres at the same time.
@@ -37,15 +39,19 @@ def copy_from_records(conn: 'psycopg2.connection', table: str, columns: list[str
   :param table: The table to write the pandas dataframe into
   :param columns: The columns being written into the table
   :param records: An iterable of records to write
+  :param commit: Commit once copied, pass False to leave it to the enclosing transaction
   '''
   import os, csv, threading
   r, w = os.pipe()
   # we copy_from_tsv with the read end of this pipe in
-  #  another thread
-  rt = threading.Thread(
-    target=copy_from_tsv,
-    args=(conn, table, columns, r,),
-  )
+  #  another thread, its error is raised in this one
+  errors = []
+  def copy():
+    try:
+      copy_from_tsv(conn, table, columns, r, commit)
+    except BaseException as e:
+      errors.append(e)
+  rt = threading.Thread(target=copy)
   rt.start()
   try:
     # we write to the write end of this pipe in this thread
@@ -53,27 +59,167 @@ def copy_from_records(conn: 'psycopg2.connection', table: str, columns: list[str
       writer = csv.DictWriter(fw, fieldnames=columns, delimiter='\t')
       writer.writeheader()
       writer.writerows(records)
+  except BrokenPipeError:
+    # the copy stopped reading, its own error is more telling
+    rt.join()
+    if not errors:
+      raise
   finally:
     # we wait for the copy_from_tsv thread to finish
     rt.join()
+  if errors:
+    raise errors[0]
 
-def import_gene_set_library(
-  plpy,
-  library: Path | str,
-  species: str = 'human',
-  prefix='',
-  postfix=''
-):
+def pg_array(values: t.Iterable) -> str:
+  ''' Format values as a postgres array literal, for array columns written with `copy_from_records`
+  '''
+  return '{' + ','.join(
+    'NULL' if value is None else '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+    for value in values
+  ) + '}'
+
+def stage_records(plpy, table: str, columns: list[str], records: t.Iterable[dict], prefix: str = 'staging') -> str:
+  ''' Stream records with `copy_from_records` into a temporary table with the `columns` of `table`
+  and a `staging_id` following the order of the records. Nothing is committed, the temporary table
+  lasts until the end of the session and it is up to the caller to drop it.
+  :param prefix: Prefix of the name of the temporary table, tables staged with different prefixes can be used together
+  :return: The name of the temporary table
+  '''
+  staging = f"{prefix}_{table.split('.')[-1]}"
+  plpy.execute(f'''
+    drop table if exists pg_temp.{staging};
+    create temporary table {staging} as select {", ".join(columns)} from {table} with no data;
+    alter table pg_temp.{staging} add column staging_id serial;
+  ''', [])
+  copy_from_records(plpy.conn, f'pg_temp.{staging}', columns, records, commit=False)
+  return f'pg_temp.{staging}'
+
+def missing_keys(plpy, table: str, column: str, keys: t.Iterable[str]) -> t.Iterator[str]:
+  ''' Stream the distinct `keys` not already in the `column` of `table`. The candidate keys are
+  copied into a temporary table and anti-joined in postgres, only the missing keys are sent back.
+  '''
+  staging = stage_records(plpy, table, (column,), ({column: key} for key in keys), prefix='candidate')
+  for key, in plpy.cursor(f'''
+    select distinct s.{column}
+    from {staging} s
+    where s.{column} is not null and not exists (
+      select 1
+      from {table} t
+      where t.{column} = s.{column}
+    )
+  ''', itersize=10000, tuples=True):
+    yield key
+  plpy.execute(f'drop table {staging}', [])
+
+def upsert_from_records(plpy, table: str, columns: list[str], records: t.Iterable[dict], conflict: list[str], update: list[str] = None, keep_staging: bool = False):
+  ''' Upsert records into a postgres table with one set-based statement, the records are first
+  staged with `stage_records`.
+  :param plpy: The plpy object
+  :param table: The table to upsert into
+  :param columns: The columns being written into the table
+  :param records: An iterable of records to write
+  :param conflict: The columns of the unique constraint of the table, only the last record of each key is kept
+  :param update: The columns updated when a row already exists, by default all columns not in `conflict`
+  :param keep_staging: Keep the staging table for follow-up statements over the same keys and return its name
+  '''
+  if update is None:
+    update = [c for c in columns if c not in conflict]
+  staging = stage_records(plpy, table, columns, records)
+  plpy.execute(f'''
+    insert into {table} ({", ".join(columns)})
+    select distinct on ({", ".join(conflict)}) {", ".join(columns)}
+    from {staging}
+    order by {", ".join(conflict)}, staging_id desc
+    on conflict ({", ".join(conflict)}) do {
+      "update set " + ", ".join(f"{c} = excluded.{c}" for c in update) if update else "nothing"
+    };
+  ''', [])
+  if keep_staging:
+    return staging
+  plpy.execute(f'drop table {staging}', [])
+
+class ViewRefresher:
+  ''' Plans the refresh of the materialized views invalidated by an ingest command.
+  Invalidated views are collected along with the materialized views depending on them, then each
+   is refreshed once, dependencies first, and concurrently when it has a unique index so readers
+   of the site are not blocked.
+  :param plpy: The plpy object
+  '''
+  def __init__(self, plpy):
+    self.plpy = plpy
+    self.stale = set()
+    # materialized views read by each materialized view
+    self.depends_on = {}
+    for row in plpy.cursor('''
+      select distinct
+        vn.nspname || '.' || v.relname as view,
+        dn.nspname || '.' || d.relname as depends_on
+      from pg_class v
+      join pg_namespace vn on vn.oid = v.relnamespace
+      join pg_rewrite r on r.ev_class = v.oid
+      join pg_depend dep on dep.objid = r.oid and dep.classid = 'pg_rewrite'::regclass and dep.refclassid = 'pg_class'::regclass
+      join pg_class d on d.oid = dep.refobjid and d.oid <> v.oid
+      join pg_namespace dn on dn.oid = d.relnamespace
+      where v.relkind = 'm' and d.relkind = 'm'
+    '''):
+      self.depends_on.setdefault(row['view'], set()).add(row['depends_on'])
+    # a concurrent refresh needs a unique index over plain columns of a populated view
+    self.concurrent = {
+      row['view']
+      for row in plpy.cursor('''
+        select distinct n.nspname || '.' || c.relname as view
+        from pg_class c
+        join pg_namespace n on n.oid = c.relnamespace
+        join pg_index i on i.indrelid = c.oid
+        where c.relkind = 'm' and c.relispopulated
+          and i.indisunique and i.indpred is null and i.indexprs is null
+      ''')
+    }
+
+  def dependents(self, view: str) -> set[str]:
+    ''' The materialized views reading `view`, directly or not
+    '''
+    dependents = set()
+    queue = [view]
+    while queue:
+      current = queue.pop()
+      for other, depends_on in self.depends_on.items():
+        if current in depends_on and other not in dependents:
+          dependents.add(other)
+          queue.append(other)
+    return dependents
+
+  def invalidate(self, *views: str):
+    for view in views:
+      self.stale.add(view)
+      self.stale |= self.dependents(view)
+
+  def refresh(self, *views: str):
+    ''' Refresh `views` now, e.g. before reading them, or every stale view by default.
+    The views depending on a refreshed view are left stale until they are refreshed.
+    '''
+    import time
+    if views:
+      self.invalidate(*views)
+      remaining = set(views)
+    else:
+      remaining = set(self.stale)
+    while remaining:
+      ready = sorted(view for view in remaining if not self.depends_on.get(view, set()) & remaining) or sorted(remaining)
+      for view in ready:
+        concurrently = 'concurrently ' if view in self.concurrent else ''
+        start = time.time()
+        self.plpy.execute(f'refresh materialized view {concurrently}{view};', [])
+        print(f'Refreshed {concurrently}{view} in {time.time() - start:.1f}s')
+        self.stale.discard(view)
+        remaining.discard(view)
+
+def read_gmt(library: Path | str, prefix='', postfix=''):
+  ''' Stream the `(term, genes)` of a GMT file, gene names are cleaned of any annotation
+  '''
   import re
-  import json
-  import uuid
-
-  # fetch the gene_set, gather the background genes
-  new_gene_sets = []
-  background_genes = set()
-  n_geneset_genes = 0
   with Path(library).open('r') as fr:
-    for line in tqdm(fr, desc='Loading gmt...'):
+    for line in fr:
       line_split = line.strip().split('\t')
       if len(line_split) < 3: continue
       term, _description, *raw_genes = line_split
@@ -84,12 +230,24 @@ def import_gene_set_library(
         for cleaned_gene in (re.split(r'[;,:\s]', raw_gene)[0],)
         if cleaned_gene
       ]
-      new_gene_sets.append(dict(
-        term=prefix+term+postfix,
-        genes=genes,
-      ))
-      background_genes.update(genes)
-      n_geneset_genes += len(genes)
+      yield prefix+term+postfix, genes
+
+def import_gene_set_library(
+  plpy,
+  library: Path | str,
+  species: str = 'human',
+  prefix='',
+  postfix=''
+):
+  import json
+  import uuid
+
+  # first pass: gather the background genes, gene sets are not kept in memory
+  background_genes = set()
+  n_gene_sets = 0
+  for _term, genes in tqdm(read_gmt(library, prefix, postfix), desc='Loading gmt...'):
+    background_genes.update(genes)
+    n_gene_sets += 1
 
   # get a mapping from background_genes to background_gene_ids
   gene_map, = plpy.cursor(
@@ -110,46 +268,55 @@ def import_gene_set_library(
     for gene in tqdm(background_genes - gene_map.keys(), desc='Preparing new genes...')
     for id in (str(uuid.uuid4()),)
   }
+  del background_genes
   if new_genes:
     copy_from_records(
       plpy.conn, 'app_public_v2.gene', ('id', 'symbol',),
-      tqdm(new_genes.values(), desc='Inserting new genes...'))
+      tqdm(new_genes.values(), desc='Inserting new genes...'),
+      commit=False)
     gene_map.update({
       new_gene['symbol']: new_gene['id']
       for new_gene in new_genes.values()
     })
 
-  existing_terms = {
-    row['term']
-    for row in plpy.cursor('select term from app_public_v2.gene_set', tuple())
-  }
-
-  copy_from_records(
-    plpy.conn, 'app_public_v2.gene_set', ('term', 'gene_ids', 'n_gene_ids', 'species',),
+  # second pass: stream the gene sets into a staging table, only the terms not
+  #  already in the database are inserted
+  staging = stage_records(
+    plpy, 'app_public_v2.gene_set', ('term', 'gene_ids', 'n_gene_ids', 'species',),
     tqdm((
       dict(
-        term=gene_set['term'],
-        gene_ids=json.dumps({gene_map[gene]: None for gene in gene_set['genes']}),
-        n_gene_ids=len(gene_set['genes']),
+        term=term,
+        gene_ids=json.dumps({gene_map[gene]: None for gene in genes}),
+        n_gene_ids=len(genes),
         species=species,
       )
-      for gene_set in new_gene_sets
-      if gene_set['term'] not in existing_terms
+      for term, genes in read_gmt(library, prefix, postfix)
     ),
-    total=len(new_gene_sets) - len(existing_terms),
-    desc='Inserting new genesets...'),
+    total=n_gene_sets,
+    desc='Staging genesets...'),
   )
+  plpy.execute(f'''
+    insert into app_public_v2.gene_set (term, gene_ids, n_gene_ids, species)
+    select distinct on (s.term) s.term, s.gene_ids, s.n_gene_ids, s.species
+    from {staging} s
+    where not exists (
+      select 1
+      from app_public_v2.gene_set gs
+      where gs.term = s.term
+    )
+    order by s.term, s.staging_id;
+    drop table {staging};
+  ''', [])
 
 def import_pb_info(plpy):
-  import requests
-  import re
+  from ncbi import NCBIClient
   from datetime import datetime
   import ast
 
   to_ingest = [
     r['pmid']
     for r in plpy.cursor(
-      f'''
+      '''
         select pmid
         from app_public_v2.gse_info
         where gse not in (
@@ -182,71 +349,62 @@ def import_pb_info(plpy):
     pb_info = {}
     to_pull = to_ingest
 
-  for i in tqdm(range(0, len(to_pull), 250), 'Pulling titles...'):
-    for j in range(10):
-      try:
-        ids_string = ",".join(to_pull[i:i+250])
-        res = requests.get(f'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi?db=pubmed&retmode=json&id={ids_string}')
-        ids_info = res.json()
-      except KeyboardInterrupt:
-        raise
-      except Exception as e:
-        traceback.print_exc()
-        print('Error resolving info. Retrying...')
-        continue
-      for id in ids_info['result']['uids']:
-        pb_info[id] = {}
-        try:
-          pb_info[id]['title'] = ids_info['result'][id]['title']
-        except KeyError:
-          pass
-        try:
-          possible_formats = ['%Y %b', '%Y %b %d']
-          for format_str in possible_formats:
-              try:
-                  date_object = datetime.strptime(ids_info['result'][id]['pubdate'], format_str)
-              except ValueError:
-                  pass
-          formatted_date = date_object.strftime("%Y-%m")
-          pb_info[id]['date'] = formatted_date
-        except ValueError:
-          pass
-        try:
-          pb_info[id]['doi']  = next((item['value'] for item in ids_info['result'][id]['articleids'] if item['idtype'] == 'doi'), None)
-        except KeyError:
-          pass
-        try:
-          pb_info[id]['pmcid']  = next((item['value'] for item in ids_info['result'][id]['articleids'] if item['idtype'] == 'pmc'), None)
-        except KeyError:
-          pass  
-      break
+  with NCBIClient() as client:
+    summaries = client.esummary(to_pull)
+  for id, summary in summaries.items():
+    pb_info[id] = {}
+    try:
+      pb_info[id]['title'] = summary['title']
+    except KeyError:
+      pass
+    try:
+      possible_formats = ['%Y %b', '%Y %b %d']
+      for format_str in possible_formats:
+          try:
+              date_object = datetime.strptime(summary['pubdate'], format_str)
+          except ValueError:
+              pass
+      formatted_date = date_object.strftime("%Y-%m")
+      pb_info[id]['date'] = formatted_date
+    except ValueError:
+      pass
+    try:
+      pb_info[id]['doi']  = next((item['value'] for item in summary['articleids'] if item['idtype'] == 'doi'), None)
+    except KeyError:
+      pass
+    try:
+      pb_info[id]['pmcid']  = next((item['value'] for item in summary['articleids'] if item['idtype'] == 'pmc'), None)
+    except KeyError:
+      pass
 
 
   with open('data/pb_info_to_ingest.json', 'w') as f:
     json.dump(pb_info, f)
 
-  already_ingested = [
-    r['pmid']
-    for r in plpy.cursor(
-      f'''
-        select pmid
-        from app_public_v2.pmid_info;
-      '''
-    )
-  ]
+  new_pmids = set(missing_keys(plpy, 'app_public_v2.pmid_info', 'pmid', (pmid for pmid in to_ingest if pmid in pb_info)))
 
-  for pmid in tqdm(to_ingest):
-    if pmid in pb_info and pmid not in already_ingested:
-      plpy.execute(
-        '''
-          insert into app_public_v2.pmid_info (pmid, pmcid, title, pub_date, doi)
-          values (%s, %s, %s, %s, %s)
-          on conflict (pmid) do nothing;
-        ''',
-        (pmid, pb_info[pmid]['pmcid'], pb_info[pmid]['title'], pb_info[pmid]['date'], pb_info[pmid]['doi'])
+  upsert_from_records(
+    plpy, 'app_public_v2.pmid_info', ('pmid', 'pmcid', 'title', 'pub_date', 'doi',),
+    tqdm((
+      dict(
+        pmid=pmid,
+        pmcid=pb_info[pmid]['pmcid'],
+        title=pb_info[pmid]['title'],
+        pub_date=pb_info[pmid]['date'],
+        doi=pb_info[pmid]['doi'],
       )
+      for pmid in new_pmids
+    ),
+    total=len(new_pmids),
+    desc='Inserting PubMed info...'),
+    conflict=('pmid',),
+    update=(),
+  )
 
-def import_gse_attrs(plpy, species='human'):
+def import_gse_attrs(plpy, species='human', views: 'ViewRefresher' = None):
+  ''' Ingest the key terms of the new GSEs of a species
+  :param views: Record the materialized views made stale for the caller to refresh, by default they are refreshed here
+  '''
   import json
   from tqdm import tqdm
 
@@ -271,48 +429,66 @@ def import_gse_attrs(plpy, species='human'):
   with open(f'data/keyterms_{species}.json') as f:
     gse_attrs = json.load(f)
 
-  for gse in tqdm(to_ingest):
-    sql = """
-        INSERT INTO app_public_v2.gse_terms (gse, llm_attrs, pubmed_attrs, mesh_attrs, species)
-        VALUES (%s, %s, %s, %s, %s)
-        ON CONFLICT (gse, species) DO UPDATE SET
-        llm_attrs = EXCLUDED.llm_attrs,
-        pubmed_attrs = EXCLUDED.pubmed_attrs,
-        mesh_attrs = EXCLUDED.mesh_attrs;
-        """
-    if gse not in gse_attrs:
-      plpy.execute(sql, (gse, [], [], [], species))
-    else:
-      llm_attrs = gse_attrs[gse]
-      pubmed_attrs = []
-      mesh_attrs = []
-      plpy.execute(sql, (gse, llm_attrs, pubmed_attrs, mesh_attrs, species))
-
-  #plpy.execute('refresh materialized view app_public_v2.terms_count_combined', [])
-
-  plpy.execute("""alter table app_public_v2.gse_info drop column gse_attrs cascade;
-                  alter table app_public_v2.gse_info add column gse_attrs varchar;
-                  UPDATE app_public_v2.gse_info gi
-                  SET    gse_attrs = array_to_string(
-                          ARRAY(
-                            SELECT val
-                            FROM   unnest(gt.llm_attrs) AS val
-                            WHERE  val IS NOT NULL
-                            UNION ALL
-                            SELECT val
-                            FROM   unnest(gt.mesh_attrs) AS val
-                            WHERE  val IS NOT NULL
-                            UNION ALL
-                            SELECT val
-                            FROM   unnest(gt.pubmed_attrs) AS val
-                            WHERE  val IS NOT NULL
-                          ), ' ')
-                  FROM   app_public_v2.gse_terms gt
-                  WHERE  gi.gse = gt.gse and gi.species = gt.species;""", [])
+  staging = upsert_from_records(
+    plpy, 'app_public_v2.gse_terms', ('gse', 'llm_attrs', 'pubmed_attrs', 'mesh_attrs', 'species',),
+    tqdm((
+      dict(
+        gse=gse,
+        llm_attrs=pg_array(gse_attrs.get(gse, [])),
+        pubmed_attrs=pg_array([]),
+        mesh_attrs=pg_array([]),
+        species=species,
+      )
+      for gse in to_ingest
+    ),
+    total=len(to_ingest),
+    desc='Inserting GSE terms...'),
+    conflict=('gse', 'species',),
+    keep_staging=True,
+  )
+
+  # denormalize the attributes of the staged GSEs only, the column and the views
+  #  depending on it are kept
+  updated, = plpy.cursor(f'''
+    with attrs as (
+      select gt.gse, gt.species, array_to_string(
+        ARRAY(
+          SELECT val
+          FROM   unnest(gt.llm_attrs) AS val
+          WHERE  val IS NOT NULL
+          UNION ALL
+          SELECT val
+          FROM   unnest(gt.mesh_attrs) AS val
+          WHERE  val IS NOT NULL
+          UNION ALL
+          SELECT val
+          FROM   unnest(gt.pubmed_attrs) AS val
+          WHERE  val IS NOT NULL
+        ), ' ') as gse_attrs
+      from {staging} s
+      join app_public_v2.gse_terms gt on gt.gse = s.gse and gt.species = s.species
+    ), updated as (
+      update app_public_v2.gse_info gi
+      set gse_attrs = attrs.gse_attrs
+      from attrs
+      where gi.gse = attrs.gse and gi.species = attrs.species
+        and gi.gse_attrs is distinct from attrs.gse_attrs
+      returning 1
+    )
+    select count(*) as n from updated;
+  ''')
+  plpy.execute(f'drop table {staging}', [])
+  print(f"Updated the attributes of {updated['n']} GSEs")
+  refresh_views = views is None
+  if refresh_views:
+    views = ViewRefresher(plpy)
+  if updated['n'] > 0:
+    views.invalidate('app_public_v2.gene_set_pmid')
+  if refresh_views:
+    views.refresh()
 
 
 def import_term_categories(plpy):
-  import pandas as pd
   from tqdm import tqdm
 
   with open('data/keyterm_categories.json') as f:
@@ -324,20 +500,30 @@ def import_term_categories(plpy):
       dict(term_name=term, category=new_cats[term])
       for term in tqdm(new_cats, desc='Inserting term categories...', total=len(new_cats))
     ),
+    commit=False,
   )
 
-  plpy.execute('refresh materialized view app_public_v2.terms_count_combined;', [])
-  plpy.execute('refresh materialized view app_public_v2.category_total_count;', [])
+  views = ViewRefresher(plpy)
+  views.invalidate('app_public_v2.terms_count_combined', 'app_public_v2.category_total_count')
+  views.refresh()
 
-def import_gse_info(plpy, species='human'):
-  import GEOparse
+def import_gse_info(plpy, species='human', views: 'ViewRefresher' = None):
+  ''' Ingest the GEO info of the new GSEs of a species and the metadata of their samples, in the
+  transaction of `plpy` so neither is committed without the other
+  :param views: Record the materialized views made stale for the caller to refresh, by default they
+   are refreshed here. The caller is then also responsible for refreshing gene_set_gse beforehand.
+  '''
+  from geo import GEOClient, series_info
   from itertools import chain
   from tqdm import tqdm
   import pandas as pd
   import json
-  from datetime import datetime
 
-  plpy.execute('refresh materialized view app_public_v2.gene_set_gse;')
+  refresh_views = views is None
+  if refresh_views:
+    # gene sets may have been ingested since gene_set_gse was last refreshed
+    views = ViewRefresher(plpy)
+    views.refresh('app_public_v2.gene_set_gse')
 
   # find subset to add info to
   to_ingest = [
@@ -366,35 +552,18 @@ def import_gse_info(plpy, species='human'):
     except:
       raise RuntimeError('Missing metadata. Please ensure path is correct.')
     
-    os.makedirs('data/geo', exist_ok=True)
-
     gse_info_to_ingest = {}
     samples_to_ingest = set()
 
-    for gse in tqdm(to_ingest, desc='Fetching GSE info...'):
-      if ',' in gse:
-        gse_split = gse.split(',')[0]
-      else:
-        gse_split = gse
-      for i in range(10):
-        try:
-          geo_meta = GEOparse.GEOparse.get_GEO(geo=gse_split, silent=True, destdir='data/geo')
-        except:
-          print(f'Failed to fetch {gse}')
-          continue
-        break
-      gse_info_to_ingest[gse] = {}
-      gse_info_to_ingest[gse]['title'] = geo_meta.get_metadata_attribute('title')
-      gse_info_to_ingest[gse]['summary'] = geo_meta.get_metadata_attribute('summary')
-      try:
-          gse_info_to_ingest[gse]['pmid'] = geo_meta.get_metadata_attribute('pubmed_id')
-      except:
-          gse_info_to_ingest[gse]['pmid'] = None
-
-      date_object = datetime.strptime(geo_meta.get_metadata_attribute('status'), "Public on %b %d %Y")
-      formatted_date = date_object.strftime("%Y-%m-%d")
-      gse_info_to_ingest[gse]['publication_date'] = formatted_date  # yyyy-mm-dd
-      gse_info_to_ingest[gse]['platform'] = geo_meta.get_metadata_attribute('platform_id')
+    accessions = {gse: gse.split(',')[0] for gse in to_ingest}
+    with GEOClient() as client:
+      series = client.series(accessions.values())
+
+    for gse, accession in accessions.items():
+      if accession not in series:
+        print(f'Failed to fetch {gse}')
+        continue
+      gse_info_to_ingest[gse] = series_info(series[accession])
       gse_info_to_ingest[gse]['species'] = species
       gse_info_to_ingest[gse]['sample_groups'] = {"samples": gse_info[gse]['samples'], "titles": gse_info[gse]['titles']}
       gse_info_to_ingest[gse]['silhouette_score'] = gse_info[gse]['silhouette_score']
@@ -416,21 +585,10 @@ def import_gse_info(plpy, species='human'):
       samples_to_ingest = json.load(f2)
 
 
-  gsms_ingested = [
-    r['gsm']
-    for r in plpy.cursor(
-      f'''
-        select gsm
-        from app_public_v2.gsm_meta
-      '''
-    )
-  ]
-
+  samples_to_ingest = set(missing_keys(plpy, 'app_public_v2.gsm_meta', 'gsm', samples_to_ingest))
 
   samps_df = pd.read_csv(f'data/gse_gsm_meta_{species}.csv').set_index('gsm')
-
-  samples_to_ingest = list(set(samples_to_ingest) - set(gsms_ingested))
-  samps_df_to_ingest = samps_df.loc[list(set(samples_to_ingest).intersection(samps_df.index))]
+  samps_df_to_ingest = samps_df.loc[list(samples_to_ingest.intersection(samps_df.index))]
 
 
   copy_from_records(
@@ -451,7 +609,8 @@ def import_gse_info(plpy, species='human'):
       if gse in gse_info_to_ingest
     ),
     total=len(to_ingest),
-    desc='Inserting GSE info..')
+    desc='Inserting GSE info..'),
+    commit=False,
   )
 
   copy_from_records(
@@ -467,11 +626,13 @@ def import_gse_info(plpy, species='human'):
       for gsm, row in samps_df_to_ingest.iterrows()
     ),
     total=len(samps_df_to_ingest),
-    desc='Inserting GSM info..')
+    desc='Inserting GSM info..'),
+    commit=False,
   )
 
-  plpy.execute('refresh materialized view app_public_v2.gene_set_pmid', [])
-  plpy.execute('refresh materialized view app_public_v2.gene_set_gse;', [])
+  views.invalidate('app_public_v2.gene_set_pmid')
+  if refresh_views:
+    views.refresh()
 
 
 def replace_infinity_with_none(obj):
@@ -492,34 +653,61 @@ def import_enrichr_terms(plpy, species='human'):
   with open(f'data/enrichr-terms-{species}.json') as f:
     enrichr_terms = json.load(f)
 
-  enrichr_terms_ingested = set([
-    r['sig']
-    for r in plpy.cursor(
-      f'''
-        select sig
-        from app_public_v2.enrichr_terms
-      '''
-    )
-  ])
+  sigs_to_ingest = set(missing_keys(plpy, 'app_public_v2.enrichr_terms', 'sig', (list(sig.keys())[0] for sig in enrichr_terms)))
+
+  def records():
+    for sig in enrichr_terms:
+      sig_name = list(sig.keys())[0]
+      if sig_name not in sigs_to_ingest:
+        continue
+      sig_terms = []
+      for lib in sig[sig_name]:
+        sig_terms += [items[0] for items in sig[sig_name][lib] if items[2] < 0.05]
+      yield dict(
+        sig=sig_name,
+        organism=species,
+        sig_terms=pg_array(sig_terms),
+        enrichr_stats=json.dumps(replace_infinity_with_none(sig[sig_name])),
+      )
+
+  upsert_from_records(
+    plpy, 'app_public_v2.enrichr_terms', ('sig', 'organism', 'sig_terms', 'enrichr_stats',),
+    tqdm(records(), total=len(sigs_to_ingest), desc='Inserting Enrichr terms...'),
+    conflict=('sig', 'organism',),
+  )
+
 
-  for sig in tqdm(enrichr_terms):
-    sql = """
-        INSERT INTO app_public_v2.enrichr_terms (sig, organism, sig_terms, enrichr_stats)
-        VALUES (%s, %s, %s, %s)
-        ON CONFLICT (sig, organism) DO UPDATE SET
-        sig_terms = EXCLUDED.sig_terms,
-        enrichr_stats = EXCLUDED.enrichr_stats;
-        """
-    sig_name = list(sig.keys())[0]
-    if sig_name in enrichr_terms_ingested:
-      continue
-    enrichr_stats=json.dumps(replace_infinity_with_none(sig[list(sig.keys())[0]]))
 
-    sig_terms = []
-    for lib in sig[sig_name]:
-      sig_terms += [items[0] for items in sig[list(sig.keys())[0]][lib] if items[2] < 0.05]
-    plpy.execute(sql, (sig_name, species, sig_terms, enrichr_stats))
+def run_in_transactions(tasks: t.Iterable[tuple], jobs: int = 1):
+  ''' Run each `(func, args, kwargs)` as `func(plpy, *args, **kwargs)`, in its own transaction on a
+  connection of the pool and up to `jobs` at a time. A failed task only rolls back its own transaction,
+  its error is raised once the others are done.
+  '''
+  from plpy import transaction
+  from concurrent.futures import ThreadPoolExecutor
+  def run(func, args, kwargs):
+    with transaction() as plpy:
+      return func(plpy, *args, **kwargs)
+  with ThreadPoolExecutor(max_workers=jobs) as executor:
+    futures = [executor.submit(run, func, args, kwargs) for func, args, kwargs in tasks]
+    return [future.result() for future in futures]
+
+def check_pool_size(connections: int):
+  ''' Fail before starting when `connections` would be held at once, rather than with a `PoolError`
+  midway once the DATABASE_POOL_SIZE connections of the pool are all taken
+  '''
+  from plpy import pool_size
+  if connections > pool_size():
+    raise click.BadParameter(f'{connections} connections would be used at once, more than DATABASE_POOL_SIZE ({pool_size()})', param_hint='--jobs')
 
+def refresh_stale_views(views: ViewRefresher):
+  ''' Refresh the views made stale by the tasks of `run_in_transactions` in a transaction of their own
+  '''
+  from plpy import transaction
+  with transaction() as plpy:
+    refresher = ViewRefresher(plpy)
+    refresher.invalidate(*views.stale)
+    refresher.refresh()
 
 
 @click.group()
@@ -542,40 +730,38 @@ def ingest(input, prefix, postfix, species):
     plpy.conn.commit()
 
 @cli.command()
-@click.option('--species', type=str, default='human', help='Terms species')
-def ingest_gse_info(species):
-  from plpy import plpy
-  try:
-    import_gse_info(plpy, species)
-  except:
-    plpy.conn.rollback()
-    raise
-  else:
-    plpy.conn.commit()
+@click.option('--species', type=str, default='human', help='Terms species, comma separated to ingest several species side by side')
+@click.option('--jobs', type=int, default=1, help='Number of database connections used in parallel')
+def ingest_gse_info(species, jobs):
+  from plpy import transaction
+  species = species.split(',')
+  check_pool_size(min(jobs, len(species)))
+  with transaction() as plpy:
+    views = ViewRefresher(plpy)
+    # gene sets may have been ingested since gene_set_gse was last refreshed
+    views.refresh('app_public_v2.gene_set_gse')
+  run_in_transactions([(import_gse_info, (s,), dict(views=views)) for s in species], jobs=jobs)
+  refresh_stale_views(views)
 
 @cli.command()
-@click.option('--species', type=str, default='human', help='Terms species')
-def ingest_enrichr_terms(species):
-  from plpy import plpy
-  try:
-    import_enrichr_terms(plpy, species)
-  except:
-    plpy.conn.rollback()
-    raise
-  else:
-    plpy.conn.commit()
+@click.option('--species', type=str, default='human', help='Terms species, comma separated to ingest several species side by side')
+@click.option('--jobs', type=int, default=1, help='Number of database connections used in parallel')
+def ingest_enrichr_terms(species, jobs):
+  species = species.split(',')
+  check_pool_size(min(jobs, len(species)))
+  run_in_transactions([(import_enrichr_terms, (s,), {}) for s in species], jobs=jobs)
 
 @cli.command()
-@click.option('--species', type=str, default='human', help='Terms species')
-def ingest_gse_attrs(species):
-  from plpy import plpy
-  try:
-    import_gse_attrs(plpy, species)
-  except:
-    plpy.conn.rollback()
-    raise
-  else:
-    plpy.conn.commit()
+@click.option('--species', type=str, default='human', help='Terms species, comma separated to ingest several species side by side')
+@click.option('--jobs', type=int, default=1, help='Number of database connections used in parallel')
+def ingest_gse_attrs(species, jobs):
+  from plpy import transaction
+  species = species.split(',')
+  check_pool_size(min(jobs, len(species)))
+  with transaction() as plpy:
+    views = ViewRefresher(plpy)
+  run_in_transactions([(import_gse_attrs, (s,), dict(views=views)) for s in species], jobs=jobs)
+  refresh_stale_views(views)
 
 @cli.command()
 def ingest_pb_info():
@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import random
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from tqdm import tqdm
+
+
+class RateLimitError(Exception):
+    def __init__(self, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TransientError(Exception):
+    ''' A failure worth retrying: connection errors, timeouts, 5xx or a model still loading
+    '''
+    def __init__(self, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    ''' Thread-safe token bucket allowing `rate` requests per second, in bursts of up to `capacity`.
+    `pause` holds back every thread, e.g. after the server reported a rate limit.
+    '''
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+class InferenceEndpoint:
+    ''' Text generation through the Hugging Face inference API, or any server speaking the
+    same protocol such as a local text-generation-inference instance.
+    :param url: The model endpoint
+    :param token: Bearer token, if the endpoint needs one
+    :param parameters: Generation parameters sent with every request
+    '''
+    def __init__(self, url: str, token: str = None, parameters: dict = None, timeout: float = 300):
+        self.name = url
+        self.url = url
+        self.parameters = parameters or {}
+        self.timeout = timeout
+        self.session = requests.Session()
+        if token:
+            self.session.headers['Authorization'] = f'Bearer {token}'
+
+    def __call__(self, inputs: str):
+        try:
+            response = self.session.post(self.url, json={'inputs': inputs, 'parameters': self.parameters}, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise TransientError(str(e)) from e
+        try:
+            output = response.json()
+        except ValueError:
+            output = {'error': response.text}
+        retry_after = response.headers.get('Retry-After')
+        retry_after = float(retry_after) if retry_after and retry_after.isdigit() else None
+        error = output.get('error') if isinstance(output, dict) else None
+        if response.status_code == 429 or (error and 'rate limit' in str(error).lower()):
+            raise RateLimitError(str(error), retry_after)
+        if response.status_code >= 500:
+            # 503 while the model loads comes with an estimate of how long it takes
+            estimated_time = output.get('estimated_time') if isinstance(output, dict) else None
+            raise TransientError(str(error), retry_after or estimated_time)
+        if error:
+            raise ValueError(error)
+        response.raise_for_status()
+        return output[0]['generated_text'] if isinstance(output, list) else output['generated_text']
+
+
+def prompt_hash(prompt: str, endpoint=None):
+    ''' Results are keyed by the prompt and the endpoint which answered it
+    '''
+    return hashlib.sha1(f"{getattr(endpoint, 'name', '')}\n{prompt}".encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    ''' Append-only JSONL of results keyed by (key, prompt hash), shared between threads.
+    Every result is written as soon as it is known so a restart never redoes finished work.
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        self.results = {}
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        torn = False
+        if os.path.exists(path):
+            with open(path) as fr:
+                for line in fr:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # the last line may be torn if the previous run was killed
+                        torn = not line.endswith('\n')
+                        continue
+                    self.results[(record['key'], record['prompt'])] = record['result']
+        self.fw = open(path, 'a')
+        if torn:
+            self.fw.write('\n')
+
+    def __contains__(self, item):
+        return item in self.results
+
+    def get(self, key: str, prompt: str, default=None):
+        return self.results.get((key, prompt), default)
+
+    def put(self, key: str, prompt: str, result):
+        with self.lock:
+            self.results[(key, prompt)] = result
+            self.fw.write(json.dumps(dict(key=key, prompt=prompt, result=result)) + '\n')
+            self.fw.flush()
+
+    def close(self):
+        self.fw.close()
+
+
+def backoff(attempt: int, base: float = 2, cap: float = 300):
+    ''' Exponential backoff with full jitter
+    '''
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def generate(prompts: dict, endpoint, cache: ResultCache, parse=lambda text: text, jobs: int = 4, rate: float = 1, max_retries: int = 6):
+    ''' Run prompts against `endpoint` from `jobs` threads and at most `rate` requests per second.
+    Rate limits pause every thread, other errors and unparsable answers are retried with
+     jittered exponential backoff. Results found in `cache` are not requested again.
+    :param prompts: A mapping from key (e.g. GSE) to prompt
+    :param endpoint: A callable from prompt to generated text raising `RateLimitError` or `TransientError`
+    :param parse: Turns generated text into the stored result, raising means the answer should be retried
+    :return: A mapping from key to result, None for keys which kept failing
+    '''
+    bucket = TokenBucket(rate, capacity=jobs)
+    results = {}
+    todo = {}
+    for key, prompt in prompts.items():
+        h = prompt_hash(prompt, endpoint)
+        if (key, h) in cache:
+            results[key] = cache.get(key, h)
+        else:
+            todo[key] = (prompt, h)
+
+    def run(key):
+        prompt, h = todo[key]
+        for attempt in range(max_retries + 1):
+            bucket.acquire()
+            try:
+                result = parse(endpoint(prompt))
+            except RateLimitError as e:
+                delay = e.retry_after or backoff(attempt, base=30, cap=3600)
+                print(f'Rate limit exceeded for {key}, pausing requests for {delay:.0f}s...')
+                bucket.pause(delay)
+            except Exception as e:
+                delay = getattr(e, 'retry_after', None) or backoff(attempt)
+                print(f'Error {e} for {key}, retrying in {delay:.0f}s...')
+                time.sleep(delay)
+            else:
+                cache.put(key, h, result)
+                return result
+        print(f'Giving up on {key} after {max_retries + 1} attempts')
+        return None
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(run, key): key for key in todo}
+        for future in tqdm(as_completed(futures), total=len(futures), desc='Generating...'):
+            results[futures[future]] = future.result()
+    return results
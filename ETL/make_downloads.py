@@ -1,26 +1,48 @@
 import os
+import re
 import json
-import shutil
-import gzip
+from glob import glob
 from tqdm import tqdm
 
+# the files of a release used by the downloads
+release_patterns = {
+    'gmt': 'out/gmts/{species}-geo-auto_{version}.gmt',
+    # the processed metadata along with the silhouette scores, see calc_confidence.py
+    'meta': 'out/meta/gse_processed_meta_{species}_{version}_conf.json',
+    'enrichr': 'out/enrichr_terms_{species}_{version}.json',
+}
 
 
-def make_downloads():
-    os.makedirs('out/downloads', exist_ok=True)
-    gmts = os.listdir('out/gmts')
-    metas = os.listdir('out/meta')
-    enrichr_tags = os.listdir('out/enrichr')
+def version_key(version: str):
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', version)]
+
 
+def release_files(species: str, versions=()):
+    ''' The files of every release of `species` found in out/, along with those of `versions`
+    whether or not they were produced yet, newest release first
+    :return: A mapping from kind of file (see `release_patterns`) to its paths
+    '''
+    files = {}
+    for kind, pattern in release_patterns.items():
+        prefix, suffix = pattern.format(species=species, version='\0').split('\0')
+        found = {path[len(prefix):len(path)-len(suffix)]: path for path in glob(f'{prefix}*{suffix}')}
+        found.update({version: pattern.format(species=species, version=version) for version in versions})
+        files[kind] = [found[version] for version in sorted(found, key=version_key, reverse=True)]
+    return files
 
-    for species in ['human', 'mouse']:
-        species_gmts = [f for f in gmts if species in f]
+
+def make_downloads(files: dict):
+    ''' Concatenate the GMTs, processed metadata and Enrichr terms of the releases of each species,
+    a signature or GSE found in several releases is taken from the newest one
+    :param files: A mapping from species to its `release_files`
+    '''
+    os.makedirs('out/downloads', exist_ok=True)
+    for species, species_files in files.items():
         sigs = set()
         with open(f'out/downloads/{species}-geo-auto.gmt','w') as wfd:
-            for f in species_gmts:
-                with open(f'out/gmts/{f}','r') as fd:
-                    lines = fd.readlines()
-                    for l in tqdm(lines):
+            for f in species_files['gmt']:
+                with open(f,'r') as fd:
+                    for l in tqdm(fd, desc=f'Concatenating {f}...'):
                         l_split = l.split('\t')
                         term = l_split[0]
                         if term in sigs:
@@ -29,22 +51,25 @@ def make_downloads():
                         genes = '\t'.join(l_split[2:])
                         wfd.write(f"{term}\t\t{genes}")
 
-                    
-
-        species_metas = [f for f in metas if species in f]
         meta_dict_combined = {}
-        for f in species_metas:
-            with open(f'out/meta/{f}','rb') as fd:
+        for f in reversed(species_files['meta']):
+            with open(f,'rb') as fd:
                 meta_dict_combined = meta_dict_combined | json.load(fd)
         with open(f'out/downloads/{species}-gse-processed-meta.json','w') as wfd:
             json.dump(meta_dict_combined, wfd)
 
-        enrichr_tags_metas = [f for f in enrichr_tags if species in f]
+        sigs = set()
         enrichr_tags_dict_combined = []
-        for f in enrichr_tags_metas:
-            with open(f'out/enrichr/{f}','rb') as fd:
-                enrichr_tags_dict_combined.extend(json.load(fd))
+        for f in species_files['enrichr']:
+            with open(f,'rb') as fd:
+                for sig in json.load(fd):
+                    if sig.keys() <= sigs:
+                        continue
+                    sigs.update(sig.keys())
+                    enrichr_tags_dict_combined.append(sig)
         with open(f'out/downloads/enrichr-terms-{species}.json','w') as wfd:
             json.dump(enrichr_tags_dict_combined, wfd)
-    
-make_downloads()
\ No newline at end of file
+
+
+if __name__ == '__main__':
+    make_downloads({species: release_files(species) for species in ['human', 'mouse']})
@@ -0,0 +1,120 @@
+import os
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+from llm import TokenBucket, ResultCache, backoff
+
+# shared by the ETL and the database ingest regardless of the working directory
+default_cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'ncbi')
+
+
+class NCBIClient:
+    ''' Batched PubMed E-utilities client.
+
+    IDs are requested `batch_size` at a time over one pooled session, within the NCBI
+     request rate (10/s with an API key, 3/s without), and the raw record of every PMID
+     is cached on disk so it is only ever downloaded once.
+    :param base_url: The E-utilities root, set NCBI_EUTILS_URL to use a local fixture server instead
+    :param api_key: Defaults to PB_API_KEY
+    :param cache_dir: Where responses are cached, one JSONL file per kind of record, defaults to
+     `data/ncbi` at the root of the repository, or NCBI_CACHE
+    :param jobs: Number of batches requested concurrently
+    '''
+    def __init__(self, base_url: str = None, api_key: str = None, cache_dir: str = None, batch_size: int = 200, jobs: int = 3, max_retries: int = 5, timeout: float = 60):
+        self.base_url = (base_url or os.getenv('NCBI_EUTILS_URL', 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils')).rstrip('/')
+        self.api_key = api_key or os.getenv('PB_API_KEY')
+        self.cache_dir = cache_dir or os.getenv('NCBI_CACHE', default_cache_dir)
+        self.batch_size = batch_size
+        self.jobs = jobs
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.bucket = TokenBucket(10 if self.api_key else 3)
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=jobs))
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=jobs))
+        self._caches = {}
+
+    def _cache(self, kind: str):
+        if kind not in self._caches:
+            self._caches[kind] = ResultCache(f'{self.cache_dir}/{kind}.jsonl')
+        return self._caches[kind]
+
+    def request(self, utility: str, **params):
+        ''' POST to an E-utility (e.g. `esummary`), retrying with backoff
+        '''
+        if self.api_key:
+            params['api_key'] = self.api_key
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                response = self.session.post(f'{self.base_url}/{utility}.fcgi', data=params, timeout=self.timeout)
+                if response.status_code == 429:
+                    self.bucket.pause(backoff(attempt, base=1, cap=60))
+                response.raise_for_status()
+                return response
+            except requests.RequestException as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = backoff(attempt)
+                print(f'Error {e} calling {utility}, retrying in {delay:.0f}s...')
+                time.sleep(delay)
+
+    def _batched(self, kind: str, ids, fetch, desc: str):
+        ''' Records of `ids` from the cache, fetching the missing ones with `fetch(batch) -> {id: record}`
+        '''
+        cache = self._cache(kind)
+        ids = list(dict.fromkeys(str(id) for id in ids))
+        missing = [id for id in ids if (id, kind) not in cache]
+        batches = [missing[i:i+self.batch_size] for i in range(0, len(missing), self.batch_size)]
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            for records in tqdm(executor.map(fetch, batches), total=len(batches), desc=desc):
+                for id, record in records.items():
+                    cache.put(id, kind, record)
+        return {id: cache.get(id, kind) for id in ids if (id, kind) in cache}
+
+    def esummary(self, pmids):
+        ''' PubMed document summaries, a mapping from PMID to its esummary JSON record
+        '''
+        def fetch(batch):
+            result = self.request('esummary', db='pubmed', retmode='json', id=','.join(batch)).json()['result']
+            return {id: result[id] for id in result.get('uids', []) if 'error' not in result[id]}
+        return self._batched('esummary', pmids, fetch, 'Pulling summaries...')
+
+    def articles(self, pmids):
+        ''' PubMed records, a mapping from PMID to its raw PubmedArticle XML
+        '''
+        def fetch(batch):
+            root = ET.fromstring(self.request('efetch', db='pubmed', retmode='xml', id=','.join(batch)).content)
+            return {
+                article.findtext('MedlineCitation/PMID'): ET.tostring(article, encoding='unicode')
+                for article in root.iter('PubmedArticle')
+            }
+        return self._batched('efetch_pubmed', pmids, fetch, 'Pulling articles...')
+
+    def abstracts(self, pmids):
+        ''' Abstract text by PMID, sections of structured abstracts are prefixed with their label
+        '''
+        abstracts = {}
+        for pmid, xml in self.articles(pmids).items():
+            sections = []
+            for section in ET.fromstring(xml).iter('AbstractText'):
+                text = ' '.join(''.join(section.itertext()).split())
+                label = section.get('Label')
+                sections.append(f'{label}: {text}' if label else text)
+            abstracts[pmid] = ' '.join(sections)
+        return abstracts
+
+    def close(self):
+        for cache in self._caches.values():
+            cache.close()
+        self._caches = {}
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,40 +1,66 @@
-import sys
-from process_ARCHS4 import *
-from compute_signatures import *
-from calc_confidence import *
-from create_meta_dict import *
-from enrichr_tags import *
-from extract_key_terms import *
-from create_gmt import *
-from make_downloads import *
+import argparse
+from process_ARCHS4 import partition_samples
+from compute_signatures import run_compute_sigs
+from calc_confidence import compute_confidence
+from create_meta_dict import create_meta_dict
+from enrichr_tags import compute_enrichr_labels
+from extract_key_terms import generate_key_terms
+from create_gmt import create_gmt
+from make_downloads import make_downloads, release_files
+from pipeline import Stage, Pipeline
 
-def new_release(species: str, version: str, base_path: str = ""):
-    print("Partitioning new samples for", species, version)
-    partition_samples(species, version, base_path)
-    print("Computing signatures for", species, version)
-    run_compute_sigs(species, version, base_path)
-    print("Creating meta dict for", species, version)
-    create_meta_dict(species, version, base_path)
-    print("Computing confidence for", species, version)
-    compute_confidence(species, version, base_path)
-    print("Creating GMT for", species, version)
-    create_gmt(species, version)
-    print("Computing Enrichr tags for", species, version)
-    compute_enrichr_labels(species, version)
-    print("Generating and categorizing key terms for", species, version)
-    generate_key_terms(species, version)
-    print("Creating updated download files")
-    make_downloads(species, version)
 
+def release_stages(species: str, version: str, base_path: str = "", sig_jobs: int = 1):
+    archs4 = f'{base_path}{species}_gene_v{version}.h5'
+    groupings = f'out/partitions/gse_groupings_{species}_{version}.json'
+    signatures = f'out/signatures_{species}_{version}.h5'
+    meta = f'out/meta/gse_processed_meta_{species}_{version}.json'
+    conf = f'out/meta/gse_processed_meta_{species}_{version}_conf.json'
+    gmt = f'out/gmts/{species}-geo-auto_{version}.gmt'
+    args = (species, version, base_path)
+    return [
+        # the embedding model is only used by one stage at a time, R runs in the worker processes of the signatures stage
+        Stage(f'{species}:partition', partition_samples, args, inputs=[archs4], outputs=[groupings], clean=[groupings], locks={'embeddings'}),
+        Stage(f'{species}:signatures', run_compute_sigs, args, inputs=[archs4, groupings], outputs=[signatures],
+              clean=[signatures, f'out/sig_queue_{species}_{version}.jsonl'], settings=dict(jobs=sig_jobs)),
+        Stage(f'{species}:meta', create_meta_dict, args, inputs=[archs4, groupings], outputs=[meta], clean=[meta]),
+        Stage(f'{species}:confidence', compute_confidence, args, inputs=[archs4, meta], outputs=[conf],
+              clean=[conf, f'out/cache/confidence_{species}_{version}.jsonl']),
+        Stage(f'{species}:gmt', create_gmt, (species, version), inputs=[signatures], outputs=[gmt]),
+        Stage(f'{species}:enrichr', compute_enrichr_labels, (species, version), dict(incremental=True),
+              inputs=[gmt, 'enrichr_libs'], outputs=[f'out/enrichr_terms_{species}_{version}.json']),
+        Stage(f'{species}:keyterms', generate_key_terms, (species, version), inputs=[conf, 'keyterm-maps'],
+              outputs=[f'out/keyterms/gse_key_terms_clean_{species}_{version}.json', f'out/keyterms/key_terms_categorized_{species}_{version}.json']),
+    ]
 
 
-if __name__ == '__main__':
-    if len(sys.argv) != 3 and len(sys.argv) != 4:
-        exit("Usage: python new_release.py <species> <version> [base_path]")
-    species = sys.argv[1]
-    version = sys.argv[2]
-    base_path = sys.argv[3] if len(sys.argv) == 4 else ""
-    new_release(species, version, base_path)
-    
+def new_release(species, version: str, base_path: str = "", jobs: int = 4, force: bool = False, sig_jobs: int = 1):
+    ''' Run the release pipeline for one or more species, see `pipeline.Pipeline`
+    :param species: A species or a list of species processed side by side
+    :param jobs: Maximum number of stages running at the same time
+    :param sig_jobs: Number of worker processes computing the signatures of each species
+    :param force: Rerun every stage even if it is up to date
+    '''
+    species = [species] if isinstance(species, str) else list(species)
+    stages = [stage for s in species for stage in release_stages(s, version, base_path, sig_jobs=sig_jobs)]
+    # the downloads also take in the releases already in out/
+    downloads = {s: release_files(s, [version]) for s in species}
+    stages.append(Stage('downloads', make_downloads, (downloads,), inputs=[
+        path for files in downloads.values() for paths in files.values() for path in paths
+    ], outputs=['out/downloads']))
+    status = Pipeline(stages, state=f'out/cache/release_{version}.json', jobs=jobs).run(force=force)
+    if any(s in ('failed', 'blocked') for s in status.values()):
+        exit(1)
+
 
-    
\ No newline at end of file
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage="python new_release.py <species> <version> [base_path] [--jobs N] [--sig-jobs N] [--force]")
+    parser.add_argument('species', help='species to process, comma separated, e.g. human,mouse')
+    parser.add_argument('version')
+    parser.add_argument('base_path', nargs='?', default="")
+    parser.add_argument('--jobs', type=int, default=4, help='maximum number of stages running at the same time')
+    parser.add_argument('--sig-jobs', type=int, default=1, help='number of worker processes computing the signatures of each species')
+    parser.add_argument('--force', action='store_true', help='rerun every stage')
+    args = parser.parse_args()
+    new_release(args.species.split(','), args.version, args.base_path, jobs=args.jobs, force=args.force, sig_jobs=args.sig_jobs)
@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class Stage:
+    ''' A step of the pipeline.
+    :param name: Unique name, e.g. human:signatures
+    :param func: Called as `func(*args, **kwargs)`
+    :param inputs: Files or directories read by the stage, stages producing them run first
+    :param outputs: Files or directories written by the stage
+    :param clean: Files removed before rerunning because an input changed, for stages which
+     otherwise skip or resume from what is already there
+    :param locks: Named resources the stage cannot share with another running stage
+    :param settings: Keyword arguments which do not change the outputs, e.g. a number of worker
+     processes, passed along with `kwargs` but changing them does not rerun the stage
+    '''
+    def __init__(self, name: str, func, args=(), kwargs=None, inputs=(), outputs=(), clean=(), locks=(), settings=None):
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.kwargs = kwargs or {}
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.clean = list(clean)
+        self.locks = set(locks)
+        self.settings = settings or {}
+
+
+def fingerprint(path: str, max_content_size: int = 64 * 2**20):
+    ''' Content hash of small files, size and modification time of large ones (e.g. ARCHS4 HDF5
+    files), combined over the files of a directory. None when the path does not exist.
+    '''
+    if os.path.isdir(path):
+        h = hashlib.sha1()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for file in sorted(files):
+                h.update(f'{os.path.relpath(os.path.join(root, file), path)}:{fingerprint(os.path.join(root, file))}\n'.encode())
+        return h.hexdigest()
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    if stat.st_size > max_content_size:
+        return f'{stat.st_size}:{stat.st_mtime_ns}'
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class Pipeline:
+    ''' Runs stages as soon as the stages producing their inputs are done, up to `jobs` at a time.
+
+    A stage is skipped when its arguments and the fingerprints of its inputs match its last
+     successful run and its outputs are unchanged since, so an interrupted or failed release
+     resumes with exactly the stages left to do. The stages depending on a failed stage are
+     not run, the others carry on.
+    :param state: JSON file recording the last successful run of every stage
+    '''
+    def __init__(self, stages, state: str, jobs: int = 4):
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_path = state
+        self.jobs = jobs
+        self.lock = threading.Lock()
+        self.state = {}
+        if os.path.exists(state):
+            with open(state) as f:
+                self.state = json.load(f)
+        producers = {output: stage.name for stage in stages for output in stage.outputs}
+        self.deps = {
+            stage.name: {producers[i] for i in stage.inputs if i in producers and producers[i] != stage.name}
+            for stage in stages
+        }
+        self.timings = {}
+
+    def input_hash(self, stage: Stage):
+        h = hashlib.sha1(repr((stage.func.__module__, stage.func.__name__, stage.args, sorted(stage.kwargs.items()))).encode())
+        for path in stage.inputs:
+            fp = fingerprint(path)
+            if fp is None:
+                raise FileNotFoundError(f'{stage.name} is missing its input {path}')
+            h.update(f'{path}:{fp}\n'.encode())
+        return h.hexdigest()
+
+    def up_to_date(self, stage: Stage, input_hash: str):
+        record = self.state.get(stage.name)
+        return (
+            record is not None and record['inputs'] == input_hash
+            and all(fingerprint(path) == fp for path, fp in record['outputs'].items())
+        )
+
+    def run_stage(self, stage: Stage, force: bool = False):
+        input_hash = self.input_hash(stage)
+        if not force and self.up_to_date(stage, input_hash):
+            return 'up to date'
+        if stage.name in self.state:
+            for path in stage.clean:
+                if os.path.exists(path):
+                    os.remove(path)
+        start = time.time()
+        stage.func(*stage.args, **stage.kwargs, **stage.settings)
+        self.timings[stage.name] = time.time() - start
+        with self.lock:
+            self.state[stage.name] = dict(
+                inputs=input_hash,
+                outputs={path: fingerprint(path) for path in stage.outputs},
+                seconds=self.timings[stage.name],
+            )
+            os.makedirs(os.path.dirname(self.state_path) or '.', exist_ok=True)
+            with open(self.state_path + '.tmp', 'w') as f:
+                json.dump(self.state, f, indent=2)
+            os.replace(self.state_path + '.tmp', self.state_path)
+        return 'done'
+
+    def run(self, force: bool = False):
+        ''' Run every stage, returns their status: done, up to date, failed or blocked
+        '''
+        status = {}
+        running = {}
+        held = set()
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while True:
+                for name, stage in self.stages.items():
+                    if name in status or name in running.values() or len(running) >= self.jobs:
+                        continue
+                    if any(status.get(dep) in ('failed', 'blocked') for dep in self.deps[name]):
+                        status[name] = 'blocked'
+                        print(f'[{name}] blocked by a failed stage')
+                    elif all(status.get(dep) in ('done', 'up to date') for dep in self.deps[name]) and not stage.locks & held:
+                        print(f'[{name}] starting')
+                        held |= stage.locks
+                        running[executor.submit(self.run_stage, stage, force)] = name
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    held -= self.stages[name].locks
+                    try:
+                        status[name] = future.result()
+                    except Exception:
+                        traceback.print_exc()
+                        status[name] = 'failed'
+                    if name in self.timings and status[name] == 'done':
+                        print(f'[{name}] {status[name]} in {self.timings[name]:.1f}s')
+                    else:
+                        print(f'[{name}] {status[name]}')
+
+        print(f'Finished in {time.time() - start:.1f}s')
+        for name in self.stages:
+            seconds = f'{self.timings[name]:10.1f}s' if name in self.timings else ''
+            print(f'  {name:40} {status.get(name, "blocked"):12} {seconds}')
+        return status
@@ -1,21 +1,44 @@
 import re
 import os
-import json
-import psycopg2, psycopg2.extras
+import uuid
+import itertools
+import threading
+import contextlib
+import psycopg2, psycopg2.extensions, psycopg2.extras, psycopg2.pool
+
+# oids of the json and jsonb types
+JSON_OIDS = {114, 3802}
+# json and jsonb values are returned as the text sent by postgres, like plpy does, rather than
+#  being parsed by psycopg2 only to be serialized again
+JSON_TEXT = psycopg2.extensions.new_type(tuple(JSON_OIDS), 'JSON_TEXT', lambda value, cur: value)
 
 class PlPyCompat:
   ''' An object that works like `plpy` does when running over plpython3u
   '''
   def __init__(self, conn) -> None:
     self.conn = conn
-  def cursor(self, query, args=[]):
-    with self.conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+  def cursor(self, query, args=[], itersize=None, tuples=False):
+    ''' Rows of a query as dicts, with JSON values as text like plpy does.
+    :param itersize: Stream the rows through a server-side cursor, fetching `itersize` rows at a time,
+     instead of loading them all. The query must be a single select.
+    :param tuples: Yield rows as tuples in the order of the selected columns
+    '''
+    if itersize:
+      cur = self.conn.cursor(name=f'plpy_{uuid.uuid4().hex}')
+      cur.itersize = itersize
+    else:
+      cur = self.conn.cursor()
+    psycopg2.extensions.register_type(JSON_TEXT, cur)
+    with cur:
       cur.execute(query, args)
-      for row in cur.fetchall():
-        yield {
-          k: json.dumps(v) if type(v) == dict else v
-          for k, v in row.items()
-        }
+      rows = iter(cur if itersize else cur.fetchall())
+      # a server-side cursor only describes its columns once the first rows are fetched
+      first = next(rows, None)
+      if first is None:
+        return
+      columns = [col.name for col in cur.description]
+      for row in itertools.chain((first,), rows):
+        yield row if tuples else dict(zip(columns, row))
   def execute(self, query, args=[]):
     with self.conn.cursor() as cur:
       cur.execute(query, args)
@@ -29,5 +52,44 @@ try:
 except ImportError:
   print('Install python-dotenv for .env support')
   
-conn = psycopg2.connect(os.environ['DATABASE_URL'])
-plpy = PlPyCompat(conn)
+_pool = None
+_pool_lock = threading.Lock()
+
+def pool_size():
+  return int(os.getenv('DATABASE_POOL_SIZE', 16))
+
+def pool():
+  ''' The connection pool to DATABASE_URL, with up to DATABASE_POOL_SIZE (16) connections.
+  Taking a connection when they are all in use raises a `PoolError`, it does not wait.
+  '''
+  global _pool
+  with _pool_lock:
+    if _pool is None:
+      _pool = psycopg2.pool.ThreadedConnectionPool(1, pool_size(), os.environ['DATABASE_URL'])
+    return _pool
+
+@contextlib.contextmanager
+def transaction():
+  ''' A `PlPyCompat` over a connection of the pool, committed when the block succeeds
+  and rolled back otherwise. Independent workloads can run side by side each in their
+  own transaction, from different threads.
+  '''
+  conn = pool().getconn()
+  try:
+    yield PlPyCompat(conn)
+  except:
+    conn.rollback()
+    raise
+  else:
+    conn.commit()
+  finally:
+    pool().putconn(conn)
+
+def __getattr__(name):
+  # `conn` and `plpy` are only connected when first used
+  global conn, plpy
+  if name in ('conn', 'plpy'):
+    conn = pool().getconn()
+    plpy = PlPyCompat(conn)
+    return globals()[name]
+  raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
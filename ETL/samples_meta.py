@@ -0,0 +1,81 @@
+import os
+import json
+import hashlib
+import h5py as h5
+import numpy as np
+import pandas as pd
+
+# columns of `samps_df` and the ARCHS4 `meta/samples` dataset they come from
+sample_fields = {
+    'gse': 'series_id',
+    'gsm': 'geo_accession',
+    'scprob': 'singlecellprobability',
+    'title': 'title',
+    'characteristics_ch1': 'characteristics_ch1',
+    'source_name_ch1': 'source_name_ch1',
+}
+# bump when the layout of the cached frame changes
+cache_version = 1
+
+
+def read_strings(dset):
+    ''' Read a whole HDF5 string dataset decoded to str in one bulk call
+    '''
+    if dset.dtype.kind == 'S':
+        return np.char.decode(dset[:], 'utf-8')
+    return dset.asstr('utf-8')[:]
+
+
+def load_samples_meta(species: str, version: str, base_path: str = "", cache_dir: str = 'out/cache'):
+    ''' Load the per-sample metadata of an ARCHS4 release as a DataFrame with the columns
+    of `sample_fields`. The frame is cached as parquet keyed by the HDF5 path, its mtime
+    and the release version so later stages skip reading and decoding the HDF5 file.
+    '''
+    file = f'{base_path}{species}_gene_v{version}.h5'
+    key = hashlib.sha1(json.dumps([
+        os.path.abspath(file), os.path.getmtime(file), version, cache_version,
+    ]).encode()).hexdigest()[:12]
+    cache = f'{cache_dir}/samples_meta_{species}_{version}_{key}.parquet'
+    if os.path.exists(cache):
+        return pd.read_parquet(cache)
+
+    with h5.File(file, 'r') as f:
+        samples = f['meta/samples']
+        samps_df = pd.DataFrame({
+            col: samples[field][:] if col == 'scprob' else read_strings(samples[field])
+            for col, field in sample_fields.items()
+        })
+
+    os.makedirs(cache_dir, exist_ok=True)
+    samps_df.to_parquet(cache + '.tmp', index=False)
+    os.replace(cache + '.tmp', cache)
+    return samps_df
+
+
+class GSEIndex:
+    ''' `samps_df` sorted by GSE with the row offsets of every GSE, so the samples of
+    a GSE are a slice lookup instead of a scan over the whole frame.
+    '''
+    def __init__(self, samps_df: pd.DataFrame):
+        self.df = samps_df.sort_values('gse', kind='stable').reset_index(drop=True)
+        gses = self.df['gse'].to_numpy()
+        starts = np.flatnonzero(np.r_[True, gses[1:] != gses[:-1]]) if len(gses) else np.array([], dtype=int)
+        stops = np.r_[starts[1:], len(gses)]
+        self.offsets = {gses[start]: (int(start), int(stop)) for start, stop in zip(starts, stops)}
+
+    def __contains__(self, gse):
+        return gse in self.offsets
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def sizes(self):
+        ''' Number of samples per GSE
+        '''
+        return {gse: stop - start for gse, (start, stop) in self.offsets.items()}
+
+    def get(self, gse):
+        ''' The rows of `gse`, empty if the GSE is not indexed
+        '''
+        start, stop = self.offsets.get(gse, (0, 0))
+        return self.df.iloc[start:stop].copy()
@@ -0,0 +1,105 @@
+import h5py as h5
+import numpy as np
+import pandas as pd
+
+
+class SignatureStore:
+    ''' All the signatures of a release in one HDF5 file.
+
+    Each field is a signatures x genes float32 matrix, chunked by blocks of signatures
+     and genes so reading one signature, one gene or a block of signatures is cheap,
+     with the signature names in `names` and the shared gene order in `genes`.
+    Appended signatures are buffered and written `buffer_size` at a time.
+    :param path: The HDF5 file, e.g. out/signatures_<species>_<version>.h5
+    :param genes: The gene universe, required when creating a new store
+    '''
+    fields = ('logFC', 't', 'adj.P.Val')
+
+    def __init__(self, path: str, genes=None, mode: str = 'a', buffer_size: int = 256):
+        self.f = h5.File(path, mode)
+        self.buffer_size = buffer_size
+        self._buffer = {}
+        if 'genes' not in self.f:
+            if genes is None:
+                raise ValueError(f'{path} is not a signature store yet, genes are required to create it')
+            genes = list(dict.fromkeys(genes))
+            self.f.create_dataset('genes', data=genes, dtype=h5.string_dtype())
+            self.f.create_dataset('names', shape=(0,), maxshape=(None,), chunks=(4096,), dtype=h5.string_dtype())
+            for field in self.fields:
+                self.f.create_dataset(
+                    field, shape=(0, len(genes)), maxshape=(None, len(genes)), dtype=np.float32,
+                    chunks=(64, min(len(genes), 4096)), compression='gzip', shuffle=True, fillvalue=np.nan,
+                )
+        self.genes = list(self.f['genes'].asstr()[:])
+        self.gene_index = {gene: j for j, gene in enumerate(self.genes)}
+        self.names = list(self.f['names'].asstr()[:])
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index or name in self._buffer
+
+    def append(self, name: str, dge: pd.DataFrame):
+        ''' Add a signature (rows indexed by gene, with the columns in `fields`), replacing
+        any previous signature with the same name. Returns the names written to disk by
+        this call, empty while they are still buffered.
+        '''
+        dge = dge[~dge.index.duplicated()].reindex(self.genes)
+        self._buffer[name] = np.stack([dge[field].to_numpy(dtype=np.float32) for field in self.fields])
+        if len(self._buffer) >= self.buffer_size:
+            return self.flush()
+        return []
+
+    def flush(self):
+        ''' Write buffered signatures, returns their names
+        '''
+        if not self._buffer:
+            return []
+        new = [name for name in self._buffer if name not in self.index]
+        n = len(self.names)
+        if new:
+            self.f['names'].resize((n + len(new),))
+            self.f['names'][n:] = new
+            for field in self.fields:
+                self.f[field].resize((n + len(new), len(self.genes)))
+            for i, name in enumerate(new):
+                self.index[name] = n + i
+            self.names.extend(new)
+        rows = np.array([self.index[name] for name in self._buffer])
+        order = np.argsort(rows)
+        values = np.stack(list(self._buffer.values()))[order]
+        for k, field in enumerate(self.fields):
+            self.f[field][list(rows[order])] = values[:, k]
+        self.f.flush()
+        flushed = list(self._buffer)
+        self._buffer = {}
+        return flushed
+
+    def get(self, name: str):
+        ''' A signature as a genes x fields DataFrame
+        '''
+        i = self.index[name]
+        return pd.DataFrame({field: self.f[field][i] for field in self.fields}, index=self.genes)
+
+    def gene(self, gene: str):
+        ''' One gene across all signatures as a signatures x fields DataFrame
+        '''
+        j = self.gene_index[gene]
+        return pd.DataFrame({field: self.f[field][:, j] for field in self.fields}, index=self.names)
+
+    def block(self, start: int, stop: int, fields=fields):
+        ''' The values of signatures `start:stop` as a mapping from field to a 2d array
+        '''
+        return {field: self.f[field][start:stop] for field in fields}
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
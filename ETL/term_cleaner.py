@@ -0,0 +1,138 @@
+import re
+import sys
+import json
+from functools import lru_cache
+
+_line_breaks = re.compile(r'[\n\r]')
+_dashes = re.compile(r'[-–—]')
+_punctuation = re.compile(r'[^\w\s()/+]')
+
+
+@lru_cache(maxsize=None)
+def string_process(s):
+    # remove newline characters
+    processed_s = _line_breaks.sub('', s)
+    # remove extra spaces
+    processed_s = ' '.join(processed_s.split())
+    # to lower case
+    processed_s = processed_s.lower()
+    # dashes
+    processed_s = _dashes.sub(' ', processed_s)
+    # remove punctuation
+    processed_s = _punctuation.sub('', processed_s)
+    return processed_s
+
+
+term_filter = set(['transcription factor', 'single cell rna seq', 
+             'mirna', 'enhancer', 'long non coding rna', 'cancer', 
+             'differentiation', 'metabolism', 'cell proliferation',
+             'rna polymerase ii', 'histone modification', 'histone acetylation'
+             'translation', 'mouse model', 'pluripotent stem cell', 'protein synthesis', 
+             'human embryonic stem cell', 'transcriptional regulation', 'chromatin remodeling', 
+             'differentially expressed gene', 'chip seq', 'atac seq', 'self renewal', 'mouse embryonic stem cell'
+             'epigenome', 'gene regulation', 'interferon Œ≥', 'chromatin', 'gene ontology', 'stem cell', 'super enhancer', 
+             'transcriptional profiling', 'protein protein interaction', 'proteomic', 'gene expression profile',
+             'metabolomic', 'histone deacetylase', 'signaling pathway', 'transcriptome analysis', 'mrna',
+             'drug resistance', 'chromatin structure', 'next generation sequencing', 'chromatin immunoprecipitation', 
+             'mrna stability', 'chemotherapy', 'transcriptional program', 'chromatin immunoprecipitation sequencing', 
+             'metabolic reprogramming', 'epigenetic reprogramming', 'single cell transcriptomic', 'proteome',
+             'chromatin binding', 'reprogramming', 'gene regulatory network', 'transcriptomic analysis', 'chromatin organization', 
+             'tumor progression', 'bulk rna seq', 'promoter', 'in vitro', 'small molecule', 'genome wide association studies',
+             'mutation', 'gene expression profiling', 'organoid', 'transcriptional response', 'clonal expansion',
+             'cancer cell', 'amino acid metabolism', 'resistance', 'in vivo', 'chromatin landscape', 'histone h3',
+             'machine learning', 'transcriptional profile', 'transcriptional change', 'gene expression program',
+             'transcriptome profiling', 'post translational modification', 'hub gene', 'tissue repair', 'single cell analysis', 
+             'transcriptional network', 'regulatory elements', 'protein translation', 'lineage plasticity', 'histone methylation',
+             'pluripotent cells', 'development', 'histone mark', 'mrna translation', 'transcriptional repression', 'transcriptional signature',
+             'cancer cells', 'metabolic pathway', 'rna interference', 'gene set enrichment analysis', 'enhancer promoter interaction', 
+             'non coding rna', 'transcription regulation', 'differential expression', 'single cell transcriptomics', 
+             'single cell transcriptome', 'protein expression', 'cellular response', 'genetic variation', 'gene network',
+             'transcriptional activity', 'differential gene expression', 'mass spectrometry', 'germ free mice', 'gene expression analysis',
+             'gene expression regulation', 'cellular proliferation', 'copy number variation', 'cancer cell lines', 
+             'genome wide association study', 'gene transcription', 'cell signaling', 'rna binding protein', 'gene expression data',
+             'cancer immunotherapy', 'smart seq', 'age', 'mrna sequencing', 'inhibitory receptors', 'mice', 'drug response', 'selectivity',
+             'gene expression pattern', 'gain of function', 'in vitro assay', 'protein coding genes', 'gene expression changes', 
+             'transcription factor network', 'transcriptomic changes', 'biological pathways', 'mouse development', 
+             'regulatory regions', 'signaling', 'gene editing', 'homeobox gene', 'gene expression comparisons', 'rna seq', 'gene expression', 'transcriptome', 'human', 'transcription', 'mouse', 'gene expression signature', 'genetic', 'genomic', 'biological sciences'])
+
+
+class TermCleaner:
+    ''' Cleans LLM key terms in a single pass.
+
+    The plural, LLM substring and manual maps and the general term filter are resolved once
+     into one table from a processed term to the terms it finally becomes, so cleaning a term
+     is a lookup instead of re-applying the synonym maps until nothing changes.
+    :param plurals_dict: keyterm-maps/<species>/plurals.json
+    :param LLM_ss_dict: keyterm-maps/<species>/LLM_substrings.json
+    :param manual_dict: keyterm-maps/manual_map.json
+    '''
+    def __init__(self, plurals_dict: dict, LLM_ss_dict: dict, manual_dict: dict, term_filter=term_filter):
+        self.plurals_dict = plurals_dict
+        self.LLM_ss_dict = LLM_ss_dict
+        self.manual_dict = manual_dict
+        self.term_filter = term_filter
+        self._expanded = {}
+        self.table = {}
+        for term in list(plurals_dict) + list(LLM_ss_dict):
+            self.resolve(term)
+
+    def expand(self, term, seen=()):
+        ''' A term replaced by its synonyms, transitively
+        '''
+        if term in self._expanded:
+            return self._expanded[term]
+        mapped = self.LLM_ss_dict.get(term, term)
+        if isinstance(mapped, str):
+            mapped = [mapped]
+        elif not isinstance(mapped, list):
+            mapped = []
+        if mapped == [term] or term in seen:
+            # a term mapping back onto itself is left as is
+            expanded = (term,)
+        else:
+            expanded = tuple(x for m in mapped for x in self.expand(m, seen + (term,)))
+        self._expanded[term] = expanded
+        return expanded
+
+    def resolve(self, term):
+        ''' The terms a processed term becomes after all the maps and the filter
+        '''
+        if term not in self.table:
+            replaced = (self.manual_dict.get(x, x) for x in self.expand(self.plurals_dict.get(term, term)))
+            self.table[term] = tuple(x for x in replaced if x not in self.term_filter)
+        return self.table[term]
+
+    def clean(self, terms):
+        ''' Clean the `;` separated key terms of a GSE as returned by the LLM
+        '''
+        if not terms:
+            return []
+        cleaned = set()
+        for s in terms.split('; '):
+            processed = string_process(s)
+            if len(processed) > 2:
+                cleaned.update(self.resolve(processed))
+        return list(cleaned)
+
+
+if __name__ == '__main__':
+    # regression check against the cleaned key terms of an earlier run
+    if len(sys.argv) != 3:
+        exit("Usage: python term_cleaner.py <species> <version>")
+    species, version = sys.argv[1:]
+    with open(f'keyterm-maps/{species}/plurals.json') as f:
+        plurals_dict = json.load(f)
+    with open(f'keyterm-maps/{species}/LLM_substrings.json') as f:
+        LLM_ss_dict = json.load(f)
+    with open('keyterm-maps/manual_map.json') as f:
+        manual_dict = json.load(f)
+    with open(f'out/keyterms/gse_key_terms_{species}_{version}.json') as f:
+        key_terms = json.load(f)
+    with open(f'out/keyterms/gse_key_terms_clean_{species}_{version}.json') as f:
+        expected = json.load(f)
+    cleaner = TermCleaner(plurals_dict, LLM_ss_dict, manual_dict)
+    mismatches = [gse for gse in expected if set(cleaner.clean(key_terms.get(gse))) != set(expected[gse])]
+    for gse in mismatches[:10]:
+        print(gse, sorted(cleaner.clean(key_terms.get(gse))), sorted(expected[gse]))
+    print(f'{len(mismatches)} of {len(expected)} GSEs differ')
+    exit(1 if mismatches else 0)
@@ -0,0 +1,65 @@
+import os
+import sys
+import json
+import random
+import jellyfish
+import numpy as np
+import pandas as pd
+
+ETL = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ETL)
+from categorize_terms import TermCategorizer
+
+
+def categorize_term(cat_df, t):
+    ''' The original extract_key_terms.categorize_terms for one new term
+    '''
+    cat_df['sim'] = cat_df['term'].apply(lambda x: jellyfish.jaro_winkler_similarity(x, t))
+    term_sim = cat_df.sort_values('sim', ascending=False)
+    return term_sim['manual_category'][:100].value_counts().idxmax()
+
+
+def ambiguous(cat_df, t):
+    ''' Whether the original result depends on how its unstable sort orders equally close terms:
+    a tie across the 100th closest term, or between the most voted categories
+    '''
+    sim = np.sort([jellyfish.jaro_winkler_similarity(x, t) for x in cat_df['term']])[::-1]
+    if sim[99] == sim[100]:
+        return True
+    closest = set(cat_df['term'][[jellyfish.jaro_winkler_similarity(x, t) >= sim[99] for x in cat_df['term']]])
+    counts = cat_df[cat_df['term'].isin(closest)]['manual_category'].value_counts()
+    return len(counts) > 1 and counts.iloc[0] == counts.iloc[1]
+
+
+def vocabulary(species, n, seed):
+    with open(f'{ETL}/keyterm-maps/{species}/LLM_substrings.json') as f:
+        LLM_ss_dict = json.load(f)
+    return random.Random(seed).sample(sorted(set(LLM_ss_dict) | {v for vs in LLM_ss_dict.values() for v in vs}), n)
+
+
+def test_exact_matches_original():
+    rng = random.Random(0)
+    terms = vocabulary('human', 1500, seed=0)
+    cat_df = pd.DataFrame(dict(term=terms, manual_category=[rng.choice(['disease', 'cell type', 'tissue', 'drug', 'gene', 'process']) for _ in terms]))
+    new_terms = [t for t in vocabulary('mouse', 200, seed=1) if t not in set(terms)]
+    compared = [t for t in new_terms if not ambiguous(cat_df, t)]
+    assert len(compared) > len(new_terms) / 2
+
+    categorizer = TermCategorizer(cat_df['term'], cat_df['manual_category'])
+    categorized = categorizer.categorize(compared, batch_size=32)
+    assert categorized == {t: categorize_term(cat_df, t) for t in compared}
+
+
+def test_shortlist_covering_the_vocabulary_is_exact():
+    rng = random.Random(0)
+    terms = vocabulary('human', 500, seed=2)
+    categories = [rng.choice('abc') for _ in terms]
+    new_terms = vocabulary('mouse', 50, seed=3)
+    exact = TermCategorizer(terms, categories, top=20)
+    assert exact.shortlist is None
+    approximate = TermCategorizer(terms, categories, top=20, shortlist=500)
+    assert approximate.shortlist is None
+    assert (exact.nearest(new_terms) == approximate.nearest(new_terms)).all()
+    # a shortlist only scores its candidates
+    approximate = TermCategorizer(terms, categories, top=20, shortlist=100)
+    assert approximate.nearest(new_terms).shape == (50, 20)
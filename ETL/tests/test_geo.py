@@ -0,0 +1,108 @@
+import os
+import sys
+import time
+import sqlite3
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from geo import GEOClient, series_info
+
+
+class AccessionViewer(BaseHTTPRequestHandler):
+    ''' A fixture GEO accession viewer answering slowly, calling `server.on_request` on every request
+    '''
+    def do_GET(self):
+        gse = parse_qs(urlparse(self.path).query)['acc'][0]
+        with self.server.lock:
+            self.server.requests.append(gse)
+        self.server.on_request(gse)
+        time.sleep(self.server.delay)
+        body = '\n'.join([
+            f'^SERIES = {gse}',
+            f'!Series_title = Title of {gse}',
+            '!Series_status = Public on Jan 02 2020',
+            '!Series_platform_id = GPL1',
+            '!Series_platform_id = GPL2',
+        ]).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), AccessionViewer)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.delay = 0.01
+    server.on_request = lambda gse: None
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}/geo/query/acc.cgi', server
+    server.shutdown()
+    server.server_close()
+
+
+def test_series(server, tmp_path):
+    url, server = server
+    cache = str(tmp_path / 'gse_meta.sqlite')
+    with GEOClient(cache_path=cache, base_url=url, rate=1000) as client:
+        series = client.series(['GSE1', 'GSE2', 'GSE1'])
+    assert series_info(series['GSE2']) == dict(title='Title of GSE2', summary=None, pmid=None, publication_date='2020-01-02', platform=['GPL1', 'GPL2'])
+    with GEOClient(cache_path=cache, base_url=url, rate=1000) as client:
+        assert client.series(['GSE1', 'GSE3']).keys() == {'GSE1', 'GSE3'}
+    assert sorted(server.requests) == ['GSE1', 'GSE2', 'GSE3']
+
+
+def test_no_write_lock_while_fetching(server, tmp_path):
+    url, server = server
+    cache = str(tmp_path / 'gse_meta.sqlite')
+    writes = []
+    lock = threading.Lock()
+    def write(gse):
+        # another writer which does not wait at all for the client, one write at a time
+        with lock:
+            db = sqlite3.connect(cache, timeout=0)
+            try:
+                with db:
+                    db.execute('insert or replace into gse_meta (gse, meta) values (?, ?)', (f'other-{gse}', '{}'))
+                writes.append(True)
+            except sqlite3.OperationalError:
+                writes.append(False)
+            finally:
+                db.close()
+    server.on_request = write
+    with GEOClient(cache_path=cache, base_url=url, rate=1000, jobs=2) as client:
+        assert len(client.series([f'GSE{i}' for i in range(30)])) == 30
+    assert len(writes) == 30 and all(writes)
+
+
+def test_concurrent_clients(server, tmp_path):
+    url, server = server
+    cache = str(tmp_path / 'gse_meta.sqlite')
+    results, errors = {}, []
+    def run(name, gses):
+        try:
+            with GEOClient(cache_path=cache, base_url=url, rate=1000, jobs=2) as client:
+                results[name] = client.series(gses)
+        except Exception as e:
+            errors.append(e)
+    threads = [
+        threading.Thread(target=run, args=('human', [f'GSE{i}' for i in range(0, 60)])),
+        threading.Thread(target=run, args=('mouse', [f'GSE{i}' for i in range(40, 100)])),
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(results['human']) == len(results['mouse']) == 60
+    with sqlite3.connect(cache) as db:
+        assert db.execute('select count(*) from gse_meta').fetchone() == (100,)
@@ -0,0 +1,118 @@
+import os
+import sys
+import json
+import types
+import contextlib
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import helper
+
+
+class Connection:
+    ''' A psycopg2 connection keeping copied rows by table until they are committed
+    '''
+    def __init__(self, fail: str = None):
+        self.fail = fail
+        self.pending = {}
+        self.committed = {}
+        self.rollbacks = 0
+
+    @contextlib.contextmanager
+    def cursor(self):
+        yield self
+
+    def copy_expert(self, sql, file):
+        table = sql.split()[1]
+        rows = file.read().decode().splitlines()
+        if table == self.fail:
+            raise RuntimeError(f'copy into {table} failed')
+        self.pending.setdefault(table, []).extend(rows)
+
+    def commit(self):
+        for table, rows in self.pending.items():
+            self.committed.setdefault(table, []).extend(rows)
+        self.pending = {}
+
+    def rollback(self):
+        self.pending = {}
+        self.rollbacks += 1
+
+
+class PlPy:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def cursor(self, query, args=[], itersize=None, tuples=False):
+        assert 'from app_public_v2.gene_set_gse' in query
+        return iter([dict(gse='GSE1', species='human'), dict(gse='GSE2', species='human')])
+
+    def execute(self, query, args=[]):
+        pass
+
+
+class Views:
+    def __init__(self):
+        self.stale = set()
+
+    def invalidate(self, *views):
+        self.stale.update(views)
+
+
+@pytest.fixture
+def database(monkeypatch, tmp_path):
+    ''' The connections taken by `plpy.transaction`, the first failing its copies into `fail`
+    '''
+    connections = []
+    fail = []
+    @contextlib.contextmanager
+    def transaction():
+        conn = Connection(fail=fail[0] if fail else None)
+        connections.append(conn)
+        try:
+            yield PlPy(conn)
+        except:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+    plpy = types.ModuleType('plpy')
+    plpy.transaction = transaction
+    plpy.pool_size = lambda: 16
+    monkeypatch.setitem(sys.modules, 'plpy', plpy)
+    # the anti-join is done by postgres, every sample is new here
+    monkeypatch.setattr(helper, 'missing_keys', lambda plpy, table, column, keys: iter(keys))
+
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('data')
+    with open('data/gse_info_to_ingest_human.json', 'w') as f:
+        json.dump({
+            gse: dict(pmid='1', title=gse, summary='', publication_date='2020-01-02', platform='GPL1', sample_groups={}, silhouette_score=0.5)
+            for gse in ('GSE1', 'GSE2')
+        }, f)
+    with open('data/samps_to_ingest_human.json', 'w') as f:
+        json.dump(['GSM1', 'GSM2', 'GSM3'], f)
+    with open('data/gse_gsm_meta_human.csv', 'w') as f:
+        f.write('gsm,gse,title,characteristics_ch1,source_name_ch1\nGSM1,GSE1,a,b,c\nGSM2,GSE1,a,b,c\nGSM3,GSE2,a,b,c\n')
+    return connections, fail
+
+
+def test_import_gse_info(database):
+    connections, _ = database
+    views = Views()
+    helper.run_in_transactions([(helper.import_gse_info, ('human',), dict(views=views))])
+    conn, = connections
+    assert len(conn.committed['app_public_v2.gse_info']) == 2
+    assert len(conn.committed['app_public_v2.gsm_meta']) == 3
+    assert views.stale == {'app_public_v2.gene_set_pmid'}
+
+
+@pytest.mark.parametrize('table', ['app_public_v2.gse_info', 'app_public_v2.gsm_meta'])
+def test_import_gse_info_failure(database, table):
+    connections, fail = database
+    fail.append(table)
+    with pytest.raises(RuntimeError):
+        helper.run_in_transactions([(helper.import_gse_info, ('human',), dict(views=Views()))])
+    # both copies are on the connection of the transaction, neither is committed
+    conn, = connections
+    assert conn.committed == {} and conn.rollbacks == 1
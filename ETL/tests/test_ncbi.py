@@ -0,0 +1,107 @@
+import os
+import sys
+import json
+import threading
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ncbi
+from ncbi import NCBIClient
+
+
+class EUtils(BaseHTTPRequestHandler):
+    ''' A fixture E-utilities server, failing the first `server.failures` requests
+    '''
+    def do_POST(self):
+        params = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        ids = params['id'][0].split(',')
+        with self.server.lock:
+            self.server.requests.append((self.path, ids))
+            fail = self.server.failures > 0
+            self.server.failures -= 1
+        if fail:
+            self.send_response(500)
+            self.end_headers()
+            return
+        if self.path.endswith('/esummary.fcgi'):
+            # PMIDs starting with 9 do not exist
+            result = {'uids': ids}
+            result.update({id: {'error': 'cannot get document summary'} if id.startswith('9') else {'uid': id, 'title': f'Title {id}'} for id in ids})
+            body = json.dumps({'result': result}).encode()
+        else:
+            articles = ''.join(
+                f'<PubmedArticle><MedlineCitation><PMID>{id}</PMID><Article><Abstract>'
+                f'<AbstractText Label="BACKGROUND">Background  {id}.</AbstractText><AbstractText>Results {id}.</AbstractText>'
+                f'</Abstract></Article></MedlineCitation></PubmedArticle>'
+                for id in ids if not id.startswith('9')
+            )
+            body = f'<PubmedArticleSet>{articles}</PubmedArticleSet>'.encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(ncbi, 'backoff', lambda attempt, **kwargs: 0)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), EUtils)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.failures = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setenv('NCBI_EUTILS_URL', f'http://127.0.0.1:{server.server_port}/entrez/eutils')
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_batches(server, tmp_path):
+    pmids = [str(i) for i in range(1000, 1025)]
+    with NCBIClient(api_key='test', cache_dir=str(tmp_path), batch_size=10) as client:
+        summaries = client.esummary(pmids + pmids[:5])
+    assert sorted(summaries) == pmids
+    assert summaries['1003']['title'] == 'Title 1003'
+    assert all(path == '/entrez/eutils/esummary.fcgi' for path, _ in server.requests)
+    assert sorted(len(ids) for _, ids in server.requests) == [5, 10, 10]
+    assert sorted(id for _, ids in server.requests for id in ids) == pmids
+
+
+def test_cache(server, tmp_path):
+    with NCBIClient(api_key='test', cache_dir=str(tmp_path), batch_size=10) as client:
+        client.esummary(['1', '2', '3', '999'])
+    # a new client reads the cache and only asks for the PMIDs it has not seen
+    with NCBIClient(api_key='test', cache_dir=str(tmp_path), batch_size=10) as client:
+        summaries = client.esummary(['1', '2', '4'])
+    assert sorted(summaries) == ['1', '2', '4']
+    assert [ids for _, ids in server.requests] == [['1', '2', '3', '999'], ['4']]
+    assert os.path.exists(tmp_path / 'esummary.jsonl')
+
+
+def test_retries(server, tmp_path):
+    server.failures = 2
+    with NCBIClient(api_key='test', cache_dir=str(tmp_path), max_retries=2) as client:
+        abstracts = client.abstracts(['11', '12', '99'])
+    assert abstracts == {
+        '11': 'BACKGROUND: Background 11. Results 11.',
+        '12': 'BACKGROUND: Background 12. Results 12.',
+    }
+    assert len(server.requests) == 3
+
+    server.failures = 3
+    with NCBIClient(api_key='test', cache_dir=str(tmp_path), max_retries=2) as client:
+        with pytest.raises(Exception):
+            client.abstracts(['13'])
+
+
+def test_default_cache_dir(monkeypatch, tmp_path):
+    monkeypatch.delenv('NCBI_CACHE', raising=False)
+    monkeypatch.chdir(tmp_path)
+    with NCBIClient() as client:
+        assert os.path.abspath(client.cache_dir) == os.path.abspath(os.path.join(os.path.dirname(ncbi.__file__), '..', 'data', 'ncbi'))
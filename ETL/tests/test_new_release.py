@@ -0,0 +1,118 @@
+import os
+import sys
+import json
+import types
+import importlib
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content if isinstance(content, str) else json.dumps(content))
+
+
+def stub_stages(calls):
+    ''' Stage modules whose functions only write the outputs declared by `release_stages`
+    '''
+    def stage(func):
+        def run(species, version, *args, **kwargs):
+            calls.append((func.__name__, species, version, kwargs))
+            func(species, version)
+        run.__name__ = func.__name__
+        return run
+
+    @stage
+    def partition_samples(species, version):
+        write(f'out/partitions/gse_groupings_{species}_{version}.json', {f'GSE{version}': {'a': ['GSM1'], 'b': ['GSM2']}})
+
+    @stage
+    def run_compute_sigs(species, version):
+        write(f'out/signatures_{species}_{version}.h5', 'store')
+
+    @stage
+    def create_meta_dict(species, version):
+        write(f'out/meta/gse_processed_meta_{species}_{version}.json', {f'GSE{version}': {'titles': {}, 'samples': {}}})
+
+    @stage
+    def compute_confidence(species, version):
+        write(f'out/meta/gse_processed_meta_{species}_{version}_conf.json', {f'GSE{version}': {'titles': {}, 'samples': {}, 'silhouette_score': 0.5}})
+
+    @stage
+    def create_gmt(species, version):
+        write(f'out/gmts/{species}-geo-auto_{version}.gmt', f'GSE{version}-a-vs-b-{species} up\t\tA\tB\n')
+
+    @stage
+    def compute_enrichr_labels(species, version):
+        write(f'out/enrichr_terms_{species}_{version}.json', [{f'GSE{version}-a-vs-b-{species} up': {}}])
+
+    @stage
+    def generate_key_terms(species, version):
+        write(f'out/keyterms/gse_key_terms_clean_{species}_{version}.json', {})
+        write(f'out/keyterms/key_terms_categorized_{species}_{version}.json', {})
+
+    funcs = dict(
+        process_ARCHS4=partition_samples, compute_signatures=run_compute_sigs, calc_confidence=compute_confidence,
+        create_meta_dict=create_meta_dict, enrichr_tags=compute_enrichr_labels, extract_key_terms=generate_key_terms,
+        create_gmt=create_gmt,
+    )
+    modules = {}
+    for name, func in funcs.items():
+        module = types.ModuleType(name)
+        setattr(module, func.__name__, func)
+        module.__all__ = [func.__name__]
+        modules[name] = module
+    return modules
+
+
+@pytest.fixture
+def release(monkeypatch, tmp_path):
+    calls = []
+    for name, module in stub_stages(calls).items():
+        monkeypatch.setitem(sys.modules, name, module)
+    monkeypatch.delitem(sys.modules, 'new_release', raising=False)
+    monkeypatch.chdir(tmp_path)
+    for species in ('human', 'mouse'):
+        write(f'{species}_gene_v2.h5', 'archs4')
+    write('enrichr_libs/lib.txt', 'term\t\tA\tB\n')
+    write('keyterm-maps/manual_map.json', {})
+    yield importlib.import_module('new_release'), calls
+    sys.modules.pop('new_release', None)
+
+
+def test_release(release):
+    new_release, calls = release
+    # a previous release of human, its signature of the same name is replaced
+    write('out/gmts/human-geo-auto_1.gmt', 'GSE1-a-vs-b-human up\t\tC\nGSE2-a-vs-b-human up\t\tOLD\n')
+    write('out/meta/gse_processed_meta_human_1_conf.json', {'GSE1': {'silhouette_score': 0.1}, 'GSE2': {'silhouette_score': 0.2}})
+    write('out/enrichr_terms_human_1.json', [{'GSE1-a-vs-b-human up': {}}, {'GSE2-a-vs-b-human up': {'old': []}}])
+
+    new_release.new_release(['human', 'mouse'], '2', jobs=4, sig_jobs=3)
+    assert sorted(name for name, *_ in calls) == sorted(2 * [
+        'partition_samples', 'run_compute_sigs', 'create_meta_dict', 'compute_confidence',
+        'create_gmt', 'compute_enrichr_labels', 'generate_key_terms',
+    ])
+    assert all(kwargs == dict(jobs=3) for name, _, _, kwargs in calls if name == 'run_compute_sigs')
+
+    with open('out/downloads/human-geo-auto.gmt') as f:
+        assert f.read() == 'GSE2-a-vs-b-human up\t\tA\tB\nGSE1-a-vs-b-human up\t\tC\n'
+    with open('out/downloads/mouse-geo-auto.gmt') as f:
+        assert f.read() == 'GSE2-a-vs-b-mouse up\t\tA\tB\n'
+    with open('out/downloads/human-gse-processed-meta.json') as f:
+        assert {gse: meta['silhouette_score'] for gse, meta in json.load(f).items()} == {'GSE1': 0.1, 'GSE2': 0.5}
+    with open('out/downloads/enrichr-terms-human.json') as f:
+        assert json.load(f) == [{'GSE2-a-vs-b-human up': {}}, {'GSE1-a-vs-b-human up': {}}]
+
+    # nothing changed, nothing runs again
+    calls.clear()
+    new_release.new_release(['human', 'mouse'], '2', jobs=4, sig_jobs=3)
+    assert calls == []
+
+    # neither do the stages of the release when an earlier release is added, only the downloads
+    write('out/gmts/mouse-geo-auto_1.gmt', 'GSE1-a-vs-b-mouse up\t\tD\n')
+    new_release.new_release(['human', 'mouse'], '2', jobs=4, sig_jobs=3)
+    assert calls == []
+    with open('out/downloads/mouse-geo-auto.gmt') as f:
+        assert f.read() == 'GSE2-a-vs-b-mouse up\t\tA\tB\nGSE1-a-vs-b-mouse up\t\tD\n'
@@ -0,0 +1,91 @@
+import os
+import sys
+import json
+import random
+import pytest
+
+ETL = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ETL)
+from term_cleaner import TermCleaner, string_process, term_filter
+
+
+def clean_terms(terms, plurals_dict, LLM_ss_dict, manual_dict, max_rounds=100):
+    ''' The original extract_key_terms.clean_terms, bounded so a cycle in the maps fails the
+    comparison instead of hanging
+    '''
+    if terms == []:
+        return []
+    term_list = [string_process(s) for s in terms.split('; ')]
+    term_list = [s for s in term_list if len(s) > 2]
+    term_list = [plurals_dict.get(term, term) for term in term_list]
+    prev_state = []
+    rounds = 0
+    while term_list != prev_state:
+        rounds += 1
+        if rounds > max_rounds:
+            return None
+        prev_state = term_list
+        term_list = []
+        for term in prev_state:
+            # Replace terms with their synonym
+            mapped = LLM_ss_dict.get(term, term)
+            if isinstance(mapped, list):
+                for x in LLM_ss_dict.get(term, term):
+                    term_list.append(x)
+            elif isinstance(mapped, str):
+                term_list.append(mapped)
+    replaced_list = [manual_dict.get(term, term) for term in term_list] # Replace terms with manual fix
+    replaced_list_cleaned = [term for term in replaced_list if term not in term_filter] # Remove general terms
+    return list(set(replaced_list_cleaned))
+
+
+def load_maps(species):
+    with open(f'{ETL}/keyterm-maps/{species}/plurals.json') as f:
+        plurals_dict = json.load(f)
+    with open(f'{ETL}/keyterm-maps/{species}/LLM_substrings.json') as f:
+        LLM_ss_dict = json.load(f)
+    with open(f'{ETL}/keyterm-maps/manual_map.json') as f:
+        manual_dict = json.load(f)
+    return plurals_dict, LLM_ss_dict, manual_dict
+
+
+def sample_terms(maps, n=2000, seed=0):
+    ''' LLM answers made of terms of the maps, with the casing, punctuation and unknown
+    terms the LLM comes up with
+    '''
+    rng = random.Random(seed)
+    plurals_dict, LLM_ss_dict, manual_dict = maps
+    vocabulary = sorted(set(plurals_dict) | set(LLM_ss_dict) | set(manual_dict) | term_filter)
+    vocabulary += ['Single-cell RNA-seq', 'T cells.', 'Mice', 'p53', 'ab', 'Unmapped term (x)', 'IL-6/STAT3']
+    variants = [str.lower, str.upper, str.title, lambda s: s + '.', lambda s: s.replace(' ', '-'), lambda s: s]
+    samples = []
+    for _ in range(n):
+        terms = rng.sample(vocabulary, rng.randint(1, 10))
+        samples.append('; '.join(rng.choice(variants)(t) for t in terms))
+    return samples
+
+
+@pytest.mark.parametrize('species', ['human', 'mouse'])
+def test_matches_clean_terms(species):
+    maps = load_maps(species)
+    cleaner = TermCleaner(*maps)
+    for terms in sample_terms(maps):
+        expected = clean_terms(terms, *maps)
+        assert expected is not None, f'the maps cycle on {terms!r}'
+        assert sorted(cleaner.clean(terms)) == sorted(expected), terms
+
+
+@pytest.mark.parametrize('species', ['human', 'mouse'])
+def test_every_mapped_term(species):
+    maps = load_maps(species)
+    cleaner = TermCleaner(*maps)
+    plurals_dict, LLM_ss_dict, _ = maps
+    for term in sorted(set(plurals_dict) | set(LLM_ss_dict)):
+        assert sorted(cleaner.clean(term)) == sorted(clean_terms(term, *maps)), term
+
+
+def test_empty():
+    cleaner = TermCleaner({}, {}, {})
+    assert cleaner.clean([]) == []
+    assert cleaner.clean(None) == []
+    assert cleaner.clean('') == []
@@ -1,17 +1,19 @@
-import GEOparse
+import os
+import sys
 import json
-from tqdm import tqdm
+
+# the GEO client and its cache are shared with the ETL
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'ETL'))
+from geo import GEOClient
 
 species = 'mouse'
 
-def extract_gse_metadata(gse_id):
-    gse = GEOparse.get_GEO(gse_id, destdir='data/geo', silent=True)
-    print()
+def extract_gse_metadata(meta):
     gse_attrs = {
-        'title': ' '.join(gse.metadata["title"]),
-        'summary': ' '.join(gse.metadata["summary"]),
-        'overall_design': ' '.join(gse.metadata["overall_design"]),
-        'date': ' '.join(gse.metadata["submission_date"])
+        'title': ' '.join(meta["title"]),
+        'summary': ' '.join(meta["summary"]),
+        'overall_design': ' '.join(meta["overall_design"]),
+        'date': ' '.join(meta["submission_date"])
     }
     return gse_attrs
 
@@ -21,14 +23,14 @@ species = 'mouse'
 with open(f'data/gse_processed_meta_{species}_{version}_conf.json') as fr:
     gse_attrs = json.load(fr)
 
+accessions = {gse: gse.split(',')[0] for gse in gse_attrs}
+with GEOClient() as client:
+    series = client.series(accessions.values())
+
 gse_meta = {}
-for gse in tqdm(list(gse_attrs)):
+for gse, accession in accessions.items():
     try:
-        if ',' in gse:
-            gse_split = gse.split(',')[0]
-            gse_meta[gse] = extract_gse_metadata(gse_split)
-        else:
-            gse_meta[gse] = extract_gse_metadata(gse)
+        gse_meta[gse] = extract_gse_metadata(series[accession])
     except Exception as e:
         print(f"Error processing {gse}: {e}")
 